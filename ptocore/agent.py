@@ -9,6 +9,8 @@ import json
 import os
 import subprocess
 import logging
+from collections import deque
+from functools import partial
 
 import dateutil.parser
 from bson.objectid import ObjectId
@@ -18,6 +20,12 @@ from .coreconfig import CoreConfig
 
 Interval = Tuple[datetime, datetime]
 
+# environment of the supervisor process taken at startup, it is passed on to every analyzer module.
+_BASE_ENV = dict(os.environ)
+
+# privileges granted to an analyzer on its own temporary collection
+_TEMPORARY_COLL_ACTIONS = ["find", "insert", "remove", "update", "createIndex"]
+
 
 class AgentError(Exception):
     pass
@@ -27,6 +35,34 @@ class AnalyzerError(Exception):
     pass
 
 
+async def _drain(stream: asyncio.StreamReader, max_size: int, chunk_size: int=65536) -> Tuple[bytes, int]:
+    """
+    Reads stream until EOF and keeps only the last max_size bytes of it.
+    :return: Tuple of the retained data and the number of bytes that were dropped from the front.
+    """
+    chunks = deque()
+    size = 0
+    dropped = 0
+    while True:
+        chunk = await stream.read(chunk_size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+
+        # drop whole chunks from the front as long as the rest still covers max_size
+        while size - len(chunks[0]) >= max_size:
+            head = chunks.popleft()
+            size -= len(head)
+            dropped += len(head)
+
+    data = b''.join(chunks)
+    if size > max_size:
+        dropped += size - max_size
+        data = data[-max_size:]
+    return data, dropped
+
+
 class AgentLoggerAdapter(logging.LoggerAdapter):
     def process(self, msg, kwargs):
         return '[%s] %s' % (self.extra['analyzer_id'], msg), kwargs
@@ -48,6 +84,10 @@ class AgentBase:
     :param git_url: The url of the git repository of the analyzer module.
     :param git_commit: The commit to run the analyzer module with.
     """
+    __slots__ = ('logger', 'analyzer_id', 'identifier', 'token', 'core_config',
+                 'input_formats', 'input_types', 'output_types',
+                 'result_timespans', 'result_max_action_id', 'result_upload_ids',
+                 'git_url', 'git_commit', 'stack', '_info_response')
 
     def __init__(self,
                  identifier: str,
@@ -79,8 +119,21 @@ class AgentBase:
         self.git_url = git_url
         self.git_commit = git_commit
 
-        # a list of cleanup coroutines for reverting in case of error
-        self.stack = []
+        # cleanup functions, called in reverse order on teardown or for reverting in case of error
+        self.stack = deque()
+
+        # response to get_info, built on the first request
+        self._info_response = None
+
+    @classmethod
+    async def create(cls, *args, loop: asyncio.AbstractEventLoop=None, **kwargs):
+        """
+        Coroutine which constructs the agent in the default executor. The constructor creates the user, role and
+        collection in MongoDB, these blocking calls would otherwise stall the event loop and all other agents.
+        Takes the same arguments as the constructor.
+        """
+        loop = loop or asyncio.get_event_loop()
+        return await loop.run_in_executor(None, partial(cls, *args, **kwargs))
 
     def _create_user(self):
         """
@@ -98,7 +151,7 @@ class AgentBase:
             privileges=[
                 {
                     "resource": {"db": cc.temporary_db.name, "collection": self.identifier},
-                    "actions": ["find", "insert", "remove", "update", "createIndex"]
+                    "actions": _TEMPORARY_COLL_ACTIONS
                 },
             ],
             roles=[]
@@ -121,7 +174,6 @@ class AgentBase:
         cc.temporary_db.remove_user(self.identifier)
         cc.temporary_db.command("dropRole", self.identifier)
 
-        self.stack.remove(self._delete_user)
         self.logger.info("user deleted")
 
     def _create_collection(self, delete_after=True):
@@ -143,34 +195,33 @@ class AgentBase:
         cc = self.core_config
         cc.temporary_db.drop_collection(self.identifier)
 
-        self.stack.remove(self._delete_collection)
         self.logger.info("collection deleted")
 
-    def _cleanup(self):
+    def _cleanup(self) -> bool:
         """
-        Call cleanup functions in the reverse order than they were added.
+        Call cleanup functions in the reverse order than they were added. Each function is called once.
+        :return: True if all cleanup functions succeeded.
         """
-        for func in reversed(self.stack):
+        success = True
+        while self.stack:
+            func = self.stack.pop()
             try:
                 func()
             except:
+                success = False
                 self.logger.exception("error during cleanup (continuing anyway):", stack_info=True)
 
         self.logger.info("cleanup done.")
+        return success
 
-    def _handle_request(self, action: str, payload: dict) -> dict:
+    def _get_info(self, payload) -> dict:
         """
-        Called by the supervisor from :func:`supervisor.Supervisor._analyzer_request` when a request from the
-        analyzer context from the analyzer module was received.
-
-        Provides credentials to services and resources and stores result info.
-        :param action: The command of the request.
-        :param payload: Additional value depending on action.
-        :return: The response message in the form of a dictionary.
+        Returns the execution info. It does not change during the lifetime of the agent, therefore it is built
+        on the first request only.
         """
-        cc = self.core_config
-        self.logger.info("requested '{}' with payload '{}'.".format(action, payload))
-        if action == 'get_info':
+        if self._info_response is None:
+            cc = self.core_config
+
             # get the necessary things to build the mongo URIs
             params = {
                 'user': self.identifier,
@@ -187,8 +238,7 @@ class AgentBase:
             # the mongo URI for use with the mongo-hadoop connector
             mongo_temporary_coll_uri = 'mongodb://{user}:{pwd}@{host}:{port}/{temp_db}.{temp_coll}'.format(**params)
 
-            self.logger.debug("returned execution info.")
-            return {
+            self._info_response = {
                 'environment':          cc.environment,
                 'mongo_uri':            mongo_uri,
                 'temporary_uri':        mongo_temporary_coll_uri,
@@ -203,87 +253,126 @@ class AgentBase:
                 'git_url':              self.git_url,
                 'git_commit':           self.git_commit
             }
-        elif action == 'get_spark':
-            self.logger.debug("returned spark config.")
-            return cc.supervisor_spark
-        elif action == 'get_distributed':
-            self.logger.debug("returned distributed config.")
-            return cc.supervisor_distributed
-        elif action == 'set_result_info':
-            try:
-                max_action_id = int(payload['max_action_id'])
-                timespans_str = payload['timespans']
-
-                if max_action_id < 0:
-                    error = 'max_action_id < 0 not allowed'
-                    self.logger.error(error)
-                    return {'error': error}
-
-                if len(timespans_str) == 0:
-                    error = 'at least one timespan is required'
-                    self.logger.error(error)
-                    return {'error': error}
-
-                if not all(len(timespan) == 2 and
-                           isinstance(timespan[0], str) and
-                           isinstance(timespan[1], str) for timespan in timespans_str):
-                    error = 'invalid timespans format. expect [("start iso string", "stop iso string"), ...]'
-                    self.logger.error(error)
-                    return {'error': error}
-
-                timespans = [(dateutil.parser.parse(start_date), dateutil.parser.parse(end_date))
-                             for start_date, end_date in timespans_str]
-
-                # TODO compact timespans using timeline
-
-            except (KeyError, ValueError, TypeError) as e:
-                error = "one or more fields {'timespans', 'max_action_id'} are invalid or missing:\n"+str(e)
-                self.logger.exception(error, stack_info=True)
+
+        self.logger.debug("returned execution info.")
+        return self._info_response
+
+    def _get_spark(self, payload) -> dict:
+        self.logger.debug("returned spark config.")
+        return self.core_config.supervisor_spark
+
+    def _get_distributed(self, payload) -> dict:
+        self.logger.debug("returned distributed config.")
+        return self.core_config.supervisor_distributed
+
+    def _set_result_info(self, payload) -> dict:
+        try:
+            max_action_id = int(payload['max_action_id'])
+            timespans_str = payload['timespans']
+
+            if max_action_id < 0:
+                error = 'max_action_id < 0 not allowed'
+                self.logger.error(error)
                 return {'error': error}
 
-            self.result_max_action_id = max_action_id
-            self.result_upload_ids = None
-            self.result_timespans = timespans
+            if len(timespans_str) == 0:
+                error = 'at least one timespan is required'
+                self.logger.error(error)
+                return {'error': error}
 
-            self.logger.debug("got max_action_id: {} and timespans: {}.".format(self.result_max_action_id,
-                                                                               self.result_timespans))
-            return {'accepted': True}
-        elif action == 'set_result_info_direct':
-            try:
-                max_action_id = int(payload['max_action_id'])
-                upload_ids_str = payload['upload_ids']
+            if not all(len(timespan) == 2 and
+                       isinstance(timespan[0], str) and
+                       isinstance(timespan[1], str) for timespan in timespans_str):
+                error = 'invalid timespans format. expect [("start iso string", "stop iso string"), ...]'
+                self.logger.error(error)
+                return {'error': error}
+
+            timespans = [(dateutil.parser.parse(start_date), dateutil.parser.parse(end_date))
+                         for start_date, end_date in timespans_str]
 
-                if max_action_id < 0:
-                    error = 'max_action_id < 0 not allowed'
-                    self.logger.error(error)
-                    return {'error': error}
+            # TODO compact timespans using timeline
 
-                if len(upload_ids_str) == 0:
-                    error = 'at least one upload_id is required'
-                    self.logger.error(error)
-                    return {'error': error}
+        except (KeyError, ValueError, TypeError) as e:
+            error = "one or more fields {'timespans', 'max_action_id'} are invalid or missing:\n"+str(e)
+            self.logger.exception(error, stack_info=True)
+            return {'error': error}
+
+        self.result_max_action_id = max_action_id
+        self.result_upload_ids = None
+        self.result_timespans = timespans
 
-                upload_ids = [ObjectId(upload_id) for upload_id in upload_ids_str]
+        self.logger.debug("got max_action_id: %s and timespans: %s.", self.result_max_action_id,
+                          self.result_timespans)
+        return {'accepted': True}
 
-            except (KeyError, ValueError, TypeError) as e:
-                error = "one or more fields {'timespans', 'max_action_id'} are invalid or missing:\n"+str(e)
-                self.logger.exception(error, stack_info=True)
+    def _set_result_info_direct(self, payload) -> dict:
+        try:
+            max_action_id = int(payload['max_action_id'])
+            upload_ids_str = payload['upload_ids']
+
+            if max_action_id < 0:
+                error = 'max_action_id < 0 not allowed'
+                self.logger.error(error)
                 return {'error': error}
 
-            self.result_max_action_id = max_action_id
-            self.result_upload_ids = upload_ids
-            self.result_timespans = None
+            if len(upload_ids_str) == 0:
+                error = 'at least one upload_id is required'
+                self.logger.error(error)
+                return {'error': error}
+
+            upload_ids = [ObjectId(upload_id) for upload_id in upload_ids_str]
+
+        except (KeyError, ValueError, TypeError) as e:
+            error = "one or more fields {'timespans', 'max_action_id'} are invalid or missing:\n"+str(e)
+            self.logger.exception(error, stack_info=True)
+            return {'error': error}
+
+        self.result_max_action_id = max_action_id
+        self.result_upload_ids = upload_ids
+        self.result_timespans = None
+
+        self.logger.debug("got max_action_id: %s and upload_ids: %s.", self.result_max_action_id,
+                          self.result_upload_ids)
+        return {'accepted': True}
+
+    # maps the action of a request to its handler
+    _request_handlers = {
+        'get_info': _get_info,
+        'get_spark': _get_spark,
+        'get_distributed': _get_distributed,
+        'set_result_info': _set_result_info,
+        'set_result_info_direct': _set_result_info_direct
+    }
+
+    def _handle_request(self, action: str, payload: dict) -> dict:
+        """
+        Called by the supervisor from :func:`supervisor.Supervisor._analyzer_request` when a request from the
+        analyzer context from the analyzer module was received.
 
-            self.logger.debug("got max_action_id: {} and timespans: {}.".format(self.result_max_action_id,
-                                                                                self.result_upload_ids))
-            return {'accepted': True}
-        else:
+        Provides credentials to services and resources and stores result info.
+        The returned dictionaries may be shared between requests and must not be modified.
+        :param action: The command of the request.
+        :param payload: Additional value depending on action.
+        :return: The response message in the form of a dictionary.
+        """
+        self.logger.info("requested '%s' with payload '%s'.", action, payload)
+
+        handler = self._request_handlers.get(action)
+        if handler is None:
             self.logger.error("don't know how to handle the request.")
             return {'error': 'unknown request'}
 
+        return handler(self, payload)
+
 
     def teardown(self):
-        raise NotImplementedError()
+        """
+        Withdraws the access to the observatory by calling all registered cleanup functions.
+        :raises AgentError: if at least one cleanup function failed.
+        """
+        if not self._cleanup():
+            # TODO add more info
+            raise AgentError()
 
 class OnlineAgent(AgentBase):
     """
@@ -294,6 +383,8 @@ class OnlineAgent(AgentBase):
     :param token: Authentication token.
     :param core_config: Configuration storage
     """
+    __slots__ = ()
+
     def __init__(self, identifier, token, core_config: CoreConfig):
 
         super().__init__(identifier, token, core_config, identifier, [], [], [], '', '')
@@ -309,18 +400,6 @@ class OnlineAgent(AgentBase):
             # TODO add more info
             raise AgentError()
 
-    def teardown(self):
-        try:
-            self._delete_user()
-            self._delete_collection()
-        except:
-            self._cleanup()
-
-            # TODO add more info
-            raise AgentError()
-        else:
-            assert(len(self.stack) == 0)
-
 
 class ModuleAgent(AgentBase):
     """
@@ -338,6 +417,11 @@ class ModuleAgent(AgentBase):
     :param ensure_clean_repo: Whether repository should be cleaned before execution.
                               Should be true for production environments.
     """
+    __slots__ = ('cmdline', 'working_dir', 'env', 'analyzer_stdout', 'analyzer_stderr')
+
+    # only the tail of this many bytes of stdout and stderr each is kept of the analyzer output
+    MAX_OUTPUT_SIZE = 1024*1024*8
+
     def __init__(self,
                  analyzer_id: str,
                  identifier: str,
@@ -358,25 +442,26 @@ class ModuleAgent(AgentBase):
         self.cmdline = cmdline
         self.working_dir = working_dir
 
-        # inherit current process environment (this is the default popen behavior) and add credentials
-        self.env = dict(os.environ)
+        # inherit the supervisor's environment (this is the default popen behavior) and add credentials
         creds = {
             'identifier': self.identifier,
             'token': token,
             'host': 'localhost',
             'port': core_config.supervisor_port
         }
-        self.env['PTO_CREDENTIALS'] = json.dumps(creds)
+        self.env = dict(_BASE_ENV, PTO_CREDENTIALS=json.dumps(creds))
 
-        self.analyzer_stdout = []
-        self.analyzer_stderr = []
+        # raw output of the analyzer module, use stdout_text and stderr_text for the decoded output
+        self.analyzer_stdout = b''
+        self.analyzer_stderr = b''
 
-        self.logger.info("module agent created with identifier {}.".format(identifier))
+        self.logger.info("module agent created with identifier %s.", identifier)
 
         try:
             if ensure_clean_repo:
                 self.logger.info("clean repository")
                 clean_repository(working_dir)
+            # deleting the collection is done in the validator
             self._create_collection(delete_after=False)
             self._create_user()
         except:
@@ -385,36 +470,53 @@ class ModuleAgent(AgentBase):
             # TODO add more info
             raise AgentError()
 
-    def teardown(self):
-        try:
-            self._delete_user()
-            # deleting the collection is done in the validator
-        except:
-            self._cleanup()
+    def discard(self):
+        """
+        Tears down the agent of an analyzer module that never ran. Unlike :func:`teardown`, the temporary collection
+        is deleted as well, because it is never passed to the validator.
+        :raises AgentError: if at least one cleanup function failed.
+        """
+        # the collection is deleted last, after the user has lost access to it
+        self.stack.appendleft(self._delete_collection)
+        self.teardown()
 
-            # TODO add more info
-            raise AgentError()
-        else:
-            assert(len(self.stack) == 0)
+    @property
+    def stdout_text(self) -> str:
+        """
+        The standard output of the analyzer module. Bytes that are not valid UTF-8 are replaced.
+        """
+        return self.analyzer_stdout.decode(errors='replace')
+
+    @property
+    def stderr_text(self) -> str:
+        """
+        The standard error of the analyzer module. Bytes that are not valid UTF-8 are replaced.
+        """
+        return self.analyzer_stderr.decode(errors='replace')
 
     async def execute(self):
         """
         Coroutine which executes the analyzer module and prints stdio and stderr to log.
         """
-        self.logger.info(
-            "executing analyzer with command line '{}' in working dir '{}'"
-                .format(self.cmdline, self.working_dir)
-        )
+        self.logger.info("executing analyzer with command line '%s' in working dir '%s'",
+                         self.cmdline, self.working_dir)
 
+        # all descriptors opened by python are non-inheritable (PEP 446), so there is nothing to close in the child
         proc = await asyncio.create_subprocess_exec(*self.cmdline, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                                    env=self.env, cwd=self.working_dir)
+                                                    env=self.env, cwd=self.working_dir, close_fds=False)
+
+        # read both pipes concurrently so that the analyzer never blocks on a full pipe buffer
+        (self.analyzer_stdout, stdout_dropped), (self.analyzer_stderr, stderr_dropped), _ = await asyncio.gather(
+            _drain(proc.stdout, self.MAX_OUTPUT_SIZE), _drain(proc.stderr, self.MAX_OUTPUT_SIZE), proc.wait())
 
-        stdout, stderr = await proc.communicate()
-        self.analyzer_stdout = stdout.decode()
-        self.analyzer_stderr = stderr.decode()
+        if stdout_dropped or stderr_dropped:
+            self.logger.warning("analyzer output truncated, dropped %d bytes of stdout and %d bytes of stderr",
+                                stdout_dropped, stderr_dropped)
 
-        self.logger.info(self.analyzer_stdout)
-        self.logger.info(self.analyzer_stderr)
+        # decoding up to MAX_OUTPUT_SIZE bytes is only worth it if the output is actually logged
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("%s", self.stdout_text)
+            self.logger.info("%s", self.stderr_text)
 
         if proc.returncode != 0:
             raise AnalyzerError("The analyzer return value was not zero.")
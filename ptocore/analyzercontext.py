@@ -6,12 +6,19 @@ import json
 import asyncio
 import os
 from collections import defaultdict
+from itertools import count
 from datetime import datetime
 from typing import Sequence, Tuple
 from warnings import warn
 
 from pymongo import MongoClient
 
+# uvloop is optional, it speeds up the round-trips to the supervisor.
+try:
+    from uvloop import new_event_loop
+except ImportError:
+    from asyncio import new_event_loop
+
 from .jsonprotocol import JsonProtocol
 from . import validation
 from . import sensitivity
@@ -36,51 +43,87 @@ class SupervisorClient(JsonProtocol):
     Implements a simple request-response based state-less protocol with token-based
     authentication for passing JSON encoded, line seperated requests to the supervisor.
 
-    Users of this class should only call the method request(), because otherwise the communication
-    may break (infinite wait, get answer for different request, etc..).
+    Every request carries a request id which the supervisor echoes in its answer, so the answer resolves the
+    future of the matching request. Older supervisors do not echo the id, then requests are matched to
+    answers in the order they were sent. Users of this class should only call the method request(),
+    because otherwise the communication may break (infinite wait, get answer for different request, etc..).
     """
+    __slots__ = ('identifier', 'token', '_pending', '_request_ids', 'loop', '_authenticated')
+
     def __init__(self, credentials):
         """
-        Establish a connection to supervisor but don't exchange any messages yet.
+        Establish a connection to supervisor and authenticate the connection.
         :param credentials: A dictionary with the keys identifier, token, host, port.
         """
         self.identifier = credentials['identifier']
         self.token = credentials['token']
 
-        self._current = None
+        # futures of requests waiting for an answer by request id, oldest first
+        self._pending = {}
+        self._request_ids = count()
 
         # get fresh and empty event loop
-        self.loop = asyncio.new_event_loop()
+        self.loop = new_event_loop()
 
         # connect to server
         # TODO add tls cert
         coro = self.loop.create_connection(lambda: self, credentials['host'], credentials['port'])
         self.loop.run_until_complete(coro)
 
+        # authenticate once for this connection. older supervisors don't understand hello and answer with an error,
+        # in this case identifier and token are sent with every request.
+        ans = self.loop.run_until_complete(self._exchange({'hello': self.identifier, 'token': self.token}))
+        self._authenticated = ans.get('hello') is True
+
     def request(self, action: str, payload: dict = None):
         """
-        Send a request (payload optional) to the supervisor.
+        Send a request (payload optional) to the supervisor and wait for the answer.
         :return: The answer dictionary of the supervisor.
         """
+        return self.loop.run_until_complete(self._request(action, payload))
+
+    async def _request(self, action: str, payload: dict = None):
+        """
+        Coroutine which sends a request to the supervisor, it must run on self.loop.
+        """
         msg = {
-            'identifier': self.identifier,
-            'token': self.token,
             'action': action,
             'payload': payload
         }
 
-        # send request
+        if not self._authenticated:
+            msg['identifier'] = self.identifier
+            msg['token'] = self.token
+
+        return await self._exchange(msg)
+
+    async def _exchange(self, msg: dict):
+        """
+        Send a message to the supervisor and wait for the answer.
+        """
+        request_id = next(self._request_ids)
+        msg['request_id'] = request_id
+
+        fut = self.loop.create_future()
+        self._pending[request_id] = fut
         self.send(msg)
 
-        # wait until self.received() is called and _current contains the response
-        # NOTE: obviously this pattern will fail if the server doesn't send exactly the same number of
-        # answers than the number of received requests.
-        self.loop.run_forever()
-        return self._current
+        return await fut
 
     def received(self, obj):
-        self._current = obj
-        self.loop.stop()
+        request_id = obj.pop('request_id', None)
+        if request_id is None and self._pending:
+            # NOTE: obviously this fallback will fail if the server doesn't send exactly the same number of
+            # answers than the number of received requests.
+            request_id = next(iter(self._pending))
+
+        fut = self._pending.pop(request_id, None)
+        if fut is None:
+            warn("Dropping message from supervisor that answers no pending request: {}".format(obj))
+            return
+
+        if not fut.cancelled():
+            fut.set_result(obj)
 
 
 class AnalyzerContext:
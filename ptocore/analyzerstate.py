@@ -2,6 +2,7 @@ from datetime import datetime
 from typing import Tuple, Sequence
 from itertools import chain
 
+from pymongo import UpdateOne
 from pymongo.collection import Collection
 
 Interval = Tuple[datetime, datetime]
@@ -166,6 +167,40 @@ class AnalyzerState:
         if doc is None:
             raise TransitionFailed("analyzer '{}' not known or in other state that '{}'".format(analyzer_id, prev_state))
 
+    def transition_op(self, analyzer_id, prev_state, next_state, args: dict=None) -> UpdateOne:
+        """
+        Like :func:`transition`, but returns the update as operation for :func:`bulk_transition`.
+        """
+        if not self.is_allowed(prev_state, next_state):
+            raise TransitionNotSupportedError()
+
+        update = {'state': next_state, 'error': None}
+        if isinstance(args, dict):
+            update.update(args)
+
+        return UpdateOne({'_id': analyzer_id, 'state': prev_state}, {'$set': update})
+
+    def transition_to_error_op(self, analyzer_id, reason: str) -> UpdateOne:
+        """
+        Like :func:`transition_to_error`, but returns the update as operation for :func:`bulk_transition`.
+        The analyzer must be in a state of our domain when the operation is executed.
+        """
+        return UpdateOne({'_id': analyzer_id, 'state': {'$in': list(transition_domains[self.domain])}},
+                         {'$set': {'state': 'error', 'error': (self.domain, reason)}})
+
+    def bulk_transition(self, ops: Sequence[UpdateOne]):
+        """
+        Executes operations created by :func:`transition_op` and :func:`transition_to_error_op` in one bulk write.
+        :raises TransitionFailed: If not all analyzers were in the expected state.
+        """
+        if len(ops) == 0:
+            return
+
+        result = self.analyzers_coll.bulk_write(list(ops), ordered=False)
+        if result.matched_count != len(ops):
+            raise TransitionFailed("only {} of {} analyzers were in the expected state"
+                                   .format(result.matched_count, len(ops)))
+
     def transition_to_error(self, analyzer_id, reason: str):
         # check if analyzer is in our domain
         doc = self[analyzer_id]
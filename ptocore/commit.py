@@ -1,42 +1,119 @@
 from datetime import datetime
-from typing import Sequence, Tuple, Callable
-from hashlib import sha1
+from typing import Sequence, Tuple, Callable, Iterable
+from hashlib import blake2b
 import logging
 
+from pymongo import HASHED
 from pymongo.collection import Collection
-from pymongo.operations import UpdateOne, InsertOne
+from pymongo.write_concern import WriteConcern
+from pymongo.operations import UpdateOne, UpdateMany
+import bson
 from bson.objectid import ObjectId
 
-from .collutils import grouper, rflatten, dict_to_sorted_list
+from .collutils import grouper
 from . import repomanager
 from .validation import ValidationError, validate, VALIDATION_COMPARE_FIELDS
 
 Interval = Tuple[datetime, datetime]
 
 
-def create_hash(obs: dict):
-    hs = sha1()
+# analyzer_id is the same for all observations of a commit, it is hashed once by hash_base()
+HASHED_KEYS = sorted(VALIDATION_COMPARE_FIELDS - {'analyzer_id'})
 
-    cmp = {key: value for key, value in obs.items() if key in VALIDATION_COMPARE_FIELDS}
 
-    for elem in rflatten(dict_to_sorted_list(cmp)):
-        hs.update(str(elem).encode('utf-8'))
+def canonicalize(obj):
+    """
+    Recursively sorts the keys of all dicts in obj so that equal observations have an equal BSON encoding.
+    """
+    if isinstance(obj, dict):
+        return {key: canonicalize(obj[key]) for key in sorted(obj.keys())}
+    elif isinstance(obj, list):
+        return [canonicalize(elem) for elem in obj]
+    else:
+        return obj
 
+
+def hash_base(analyzer_id: str):
+    """
+    Hash state covering the analyzer_id. Pass it to create_hash() for every observation of this analyzer.
+    """
+    return blake2b(bson.encode({'analyzer_id': analyzer_id}), digest_size=20)
+
+
+def create_hash(obs: dict, base):
+    # the hash is only used to find counterparts, collisions are caught by equal_observation().
+    # BSON length-prefixes every element and subdocument, therefore the encoding is unambiguous.
+    # dicts keep their insertion order (python 3.7), therefore bson.encode() writes the keys sorted.
+    cmp = {key: canonicalize(obs[key]) for key in HASHED_KEYS if key in obs}
+
+    hs = base.copy()
+    hs.update(bson.encode(cmp))
     return hs.digest()
 
 
+def timespan_subquery(start: datetime, stop: datetime) -> dict:
+    """
+    Query matching observations whose time (or time interval) lies within start and stop.
+    The query is built fresh on every call, the caller may modify it.
+    Range comparisons only match values of the same BSON type, therefore no $type check is necessary.
+    """
+    return {'$or': [
+        {'time': {'$gte': start, '$lte': stop}},
+        {'time.from': {'$gte': start, '$lte': stop}, 'time.to': {'$gte': start, '$lte': stop}}
+    ]}
+
+
+def timespans_query(analyzer_id: str, timespans: Sequence[Interval]) -> dict:
+    """
+    Query matching observations of the given analyzer whose time (or time interval) lies within any timespan.
+    The outer bounds of all timespans form a single range that can use the indexes on time and time.from,
+    the exact timespans only filter the documents within this range.
+    """
+    query = {'analyzer_id': analyzer_id}
+    query.update(timespan_subquery(min(timespan[0] for timespan in timespans),
+                                   max(timespan[1] for timespan in timespans)))
+
+    if len(timespans) > 1:
+        query['$and'] = [{'$or': [timespan_subquery(timespan[0], timespan[1]) for timespan in timespans]}]
+
+    return query
+
+
 def equal_observation(a: dict, b: dict):
     return all(a[key] == b[key] for key in VALIDATION_COMPARE_FIELDS)
 
 
-def find_counterpart(candidate: dict, temporary_coll: Collection):
-    hash = create_hash(candidate)
+# fields needed to hash an observation, _id is included implicitly
+HASH_PROJECTION = dict.fromkeys(HASHED_KEYS, 1)
+
+# fields needed to compare a counterpart with its candidate
+COUNTERPART_PROJECTION = dict.fromkeys(VALIDATION_COMPARE_FIELDS | {'_id', 'hash'}, 1)
+
+# fields needed to compare a candidate and to determine if it is currently valid
+CANDIDATE_PROJECTION = dict(dict.fromkeys(VALIDATION_COMPARE_FIELDS, 1), action_ids={'$slice': 1})
+
+
+def find_counterparts(candidates: Iterable[dict], temporary_coll: Collection, base):
+    """
+    Generator yielding a tuple (candidate, counterpart) for every candidate. counterpart is None if the temporary
+    collection has no equal observation. The counterparts are looked up with one query per block of candidates.
+    """
+    for block in grouper(candidates, 1000):
+        hashes = [create_hash(candidate, base) for candidate in block]
 
-    for counterpart in temporary_coll.find({'hash': hash}):
-        if equal_observation(candidate, counterpart):
-            return candidate, counterpart
+        by_hash = {}
+        for counterpart in temporary_coll.find({'hash': {'$in': list(set(hashes))}}, COUNTERPART_PROJECTION,
+                                               batch_size=1000):
+            by_hash.setdefault(counterpart['hash'], []).append(counterpart)
 
-    return None
+        for candidate, hash in zip(block, hashes):
+            found = None
+            for counterpart in by_hash.get(hash, ()):
+                if equal_observation(candidate, counterpart):
+                    found = counterpart
+                    break
+
+            yield candidate, found
 
 
 def get_repo_info(self, analyzer_id: str, repo_path: str):
@@ -50,12 +127,13 @@ def get_repo_info(self, analyzer_id: str, repo_path: str):
                               "analyzer: '{}', working_dir: '{}'.".format(analyzer_id, repo_path)) from e
 
 
-def compute_hashes(coll: Collection):
-    for obs_group in grouper(coll.find(), 1000):
-        bulk = [UpdateOne({'_id': obs['_id']}, {'$set': {'hash': create_hash(obs)}}) for obs in obs_group]
-        coll.bulk_write(bulk)
+def compute_hashes(coll: Collection, base):
+    # the index is filled while writing the hashes. it only serves equality lookups, therefore a hashed index.
+    coll.create_index([('hash', HASHED)])
 
-    coll.create_index('hash')
+    for obs_group in grouper(coll.find({}, HASH_PROJECTION, batch_size=5000), 1000):
+        bulk = [UpdateOne({'_id': obs['_id']}, {'$set': {'hash': create_hash(obs, base)}}) for obs in obs_group]
+        coll.bulk_write(bulk, ordered=False)
 
 
 def perform_commit(analyzer_id: str,
@@ -71,6 +149,10 @@ def perform_commit(analyzer_id: str,
                    action_log: Collection,
                    action_id: int):
 
+    # the hashes and marks are dropped with the temporary collection after the commit, there is no need to wait
+    # for the journal. the final $merge into the output collection keeps the default write concern.
+    scratch_coll = temporary_coll.with_options(write_concern=WriteConcern(w=1, j=False))
+
     # 1. create action_log entry.
     # note the sensor will not run downstream analyzers as long as this analyzer is in validating state.
     action_log.insert_one({
@@ -85,75 +167,93 @@ def perform_commit(analyzer_id: str,
         'git_commit': git_commit
     })
 
-    # 2. create hashes for counterpart search
-    compute_hashes(temporary_coll)
-
-    # 3. find all observations that exist both in the output collection and in the temporary collection
-    print("2. find candidates")
-    candidates = output_coll.find(candidates_query)
-
-    # 4. find and mark all of them in the temporary collection, they will be set to valid again
-    print("3. find counterparts and mark them")
-    pairs = filter(None, (find_counterpart(candidate, temporary_coll) for candidate in candidates))
-
-    mark_ops = (UpdateOne({'_id': pair[1]['_id']}, {'$set': {'output_id': pair[0]['_id']}}) for pair in pairs)
-
-    # unfortunately bulk_write does not accept iterators. in the mongodb docs, the server limit is 1000 ops.
-    for block in grouper(mark_ops, 1000):
-        print(".")
-        temporary_coll.bulk_write(list(block))
-
-    #
-    # WRITE TO OBSERVATIONS COLLECTION STARTS FROM HERE
-    #
-
-    # 5. push a new action_id and valid: False to all candidates that were valid before.
-    # later in the code this item is removed iff the candidate is still valid.
-    candidates_query_valid = candidates_query.copy()
-    candidates_query_valid.update({
-        'action_ids.0.valid': True
-    })
-
-    num_marked_false = output_coll.update_many(candidates_query_valid, {
-        '$push': {'action_ids': {
-            '$each': [{'id': action_id, 'valid': False}],
-            '$position': 0
-        }}
-    }).modified_count
-
-    print("marked false: {}".format(num_marked_false))
-
-    # 6. perform actual commit
-    print("e. insert new or validate existing observations.")
-    def create_output_ops():
+    # fresh timespans have no observations in the output collection. in this case there are no counterparts to
+    # search and nothing to invalidate, every temporary document is simply inserted.
+    has_overlap = output_coll.count_documents(candidates_query, limit=1) > 0
+    num_marked_false = 0
+
+    if has_overlap:
+        # 2. create hashes for counterpart search
+        base = hash_base(analyzer_id)
+        compute_hashes(scratch_coll, base)
+
+        # 3. find all observations that exist both in the output collection and in the temporary collection
+        print("2. find candidates")
+        candidates = output_coll.find(candidates_query, CANDIDATE_PROJECTION, batch_size=5000)
+
+        # 4. find the counterparts of the candidates and mark them in the temporary collection.
+        # candidates with a counterpart are kept, candidates without are invalidated if they were valid before.
+        print("3. find counterparts and mark them")
+
+        # temporary _id -> (output _id, was valid before)
+        counterparts = {}
+        invalidate_ids = []
+        for candidate, counterpart in find_counterparts(candidates, temporary_coll, base):
+            entry = (candidate['_id'], candidate['action_ids'][0]['valid'])
+            if counterpart is not None:
+                # if several candidates share the same counterpart, only the last one is kept
+                replaced = counterparts.get(counterpart['_id'])
+                counterparts[counterpart['_id']] = entry
+                entry = replaced
+
+            if entry is not None and entry[1] is True:
+                invalidate_ids.append(entry[0])
+
+        mark_ops = (UpdateOne({'_id': temporary_id}, {'$set': {'output_id': output_id}})
+                    for temporary_id, (output_id, _) in counterparts.items())
+
+        # pymongo splits each bulk_write into batches within the server limits. the chunks only bound the memory.
+        for block in grouper(mark_ops, 100000):
+            print(".")
+            scratch_coll.bulk_write(block, ordered=False)
+
+        #
+        # WRITE TO OBSERVATIONS COLLECTION STARTS FROM HERE
+        #
+
+        # 5. push a new action_id and valid: False to all candidates that were valid before and are not kept and
+        # valid: True to all kept candidates that were invalid before. kept candidates that were valid stay unchanged.
+        revalidate_ids = [output_id for output_id, valid in counterparts.values() if valid is False]
+        kept = len(counterparts)
+
+        def push_ops(ids, valid: bool):
+            return [UpdateMany({'_id': {'$in': block}, 'action_ids.0.valid': not valid}, {
+                '$push': {'action_ids': {
+                    '$each': [{'id': action_id, 'valid': valid}],
+                    '$position': 0
+                }}
+            }) for block in grouper(ids, 1000)]
+
+        output_ops = push_ops(invalidate_ids, False) + push_ops(revalidate_ids, True)
+
+        if len(output_ops) > 0:
+            output_coll.bulk_write(output_ops, ordered=False)
+
+        num_marked_false = len(invalidate_ids)
+
+        print("marked false: {}, marked true: {}".format(num_marked_false, len(revalidate_ids)))
+    else:
+        print("no existing observations in given timespans, skip counterpart search")
         kept = 0
-        inserted = 0
-        # generator that iterates over temporary coll and create operations for output collection
-        # note that the find query projection is {'_id': 0}: using this we can simply insert the document
-        # into the output collection
-        for doc in temporary_coll.find({}, {'_id': 0}):
-            if 'output_id' in doc:
-                # if observation was valid before, pop the current item because validation status hasn't changed
-                yield UpdateOne({'_id': doc['output_id'], 'action_ids.0.id': action_id, 'action_ids.1.valid': True},
-                                {'$pop': {'action_ids': -1}})
-
-                # if observation was invalid before, push a valid item
-                yield UpdateOne({'_id': doc['output_id'], 'action_ids.0.valid': False},
-                                {'$push': {
-                                    'action_ids': {'$each': [{'id': action_id, 'valid': True}], '$position': 0}
-                                }})
-
-                kept+=1
-            else:
-                yield InsertOne(doc)
-                inserted+=1
 
-        deprecated = max(num_marked_false - kept, 0)
+    # 6. insert new observations. this step runs server-side using $merge (requires MongoDB 4.2), the documents of
+    # the temporary collection never travel through the validator. the output collection assigns new _ids,
+    # the hash is only used within the commit.
+    print("e. insert new observations.")
+    inserted = temporary_coll.count_documents({'output_id': {'$exists': False}})
 
-        print("commit stats: deprecated(+)/undeprecated(-): {}, kept {}, added: {}".format(deprecated, kept, inserted))
+    if inserted > 0:
+        temporary_coll.aggregate([
+            {'$match': {'output_id': {'$exists': False}}},
+            {'$project': {'_id': 0, 'hash': 0}},
+            {'$merge': {
+                'into': {'db': output_coll.database.name, 'coll': output_coll.name},
+                'whenMatched': 'fail',
+                'whenNotMatched': 'insert'
+            }}
+        ])
 
-    for block in grouper(create_output_ops(), 1000):
-        output_coll.bulk_write(list(block))
+    print("commit stats: deprecated: {}, kept {}, added: {}".format(num_marked_false, kept, inserted))
 
 
 def action_ids_timespans_from_uploads(upload_ids: Sequence[ObjectId], action_log: Collection) -> Tuple[Sequence[int], Sequence[Interval]]:
@@ -248,16 +348,7 @@ def commit_normal(analyzer_id: str,
 
     # query to find candidates to invalidate
     print("b. determine candidates to invalidate")
-    def create_timespan_subquery(timespan: Interval):
-        return {'$or': [
-            {'time': {'$type': 'date', '$gte': timespan[0], '$lte': timespan[1]}},
-            {'$and': [
-                {'time.from': {'$type': 'date', '$gte': timespan[0], '$lte': timespan[1]}},
-                {'time.to': {'$type': 'date', '$gte': timespan[0], '$lte': timespan[1]}}
-            ]}
-        ]}
-
-    candidates_query = {'analyzer_id': analyzer_id, '$or': [create_timespan_subquery(timespan) for timespan in timespans]}
+    candidates_query = timespans_query(analyzer_id, timespans)
 
     perform_commit(analyzer_id, output_types, timespans, None, max_action_id, git_url, git_commit,
                    temporary_coll, output_coll, candidates_query, action_log, action_id)
@@ -1,10 +1,13 @@
 import json
+import os
 
 from pymongo import MongoClient
 import dpath.util
 
 
 class CoreConfig:
+    MONGO_POOL_DEFAULTS = {'maxPoolSize': 50, 'minPoolSize': 5}
+
     def __init__(self, program_name: str, fps):
         assert(program_name in ['sensor', 'supervisor', 'validator', 'admin'])
         doc = {}
@@ -17,7 +20,12 @@ class CoreConfig:
         # > "majority" write concern against the primary of the replica set.
         # TODO change this when server is started with `--enableMajorityReadConcern`
         #self.mongo = MongoClient(doc[program_name]['mongo_uri'], w="majority", readConcernLevel="majority")
-        self.mongo = MongoClient(doc[program_name]['mongo_uri'])
+
+        # this is the only client of the program. all components and agents share its connection pool,
+        # the pool options can be overridden by the optional 'mongo_pool' dict in the program's config.
+        pool_options = dict(CoreConfig.MONGO_POOL_DEFAULTS)
+        pool_options.update(doc[program_name].get('mongo_pool', {}))
+        self.mongo = MongoClient(doc[program_name]['mongo_uri'], **pool_options)
 
         self.environment = doc['environment']
 
@@ -49,6 +57,8 @@ class CoreConfig:
             self.supervisor_spark = doc['supervisor']['spark']
             self.supervisor_distributed = doc['supervisor']['distributed']
             self.supervisor_ensure_clean_repo = doc['supervisor']['ensure_clean_repo']
+            # maximum number of analyzer modules executing at the same time
+            self.supervisor_max_concurrent = doc['supervisor'].get('max_concurrent', os.cpu_count() or 1)
 
         # admin specific
         if program_name == "admin":
@@ -57,3 +67,5 @@ class CoreConfig:
         # validator specific
         if program_name == "validator":
             self.validator_upload_filter = doc['validator'].get('upload_filter')
+            # maximum number of analyzer runs committed at the same time
+            self.validator_max_concurrent = doc['validator'].get('max_concurrent', 8)
@@ -1,40 +1,90 @@
 import asyncio
 import json
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+# orjson is optional, it encodes and decodes considerably faster than the json module.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj):
+    """
+    Encodes the types that the json module does not know. orjson handles datetime by itself in the same format.
+    """
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+if orjson is not None:
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+    loads = orjson.loads
+else:
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, default=_default, separators=(',', ':')).encode()
+
+    loads = json.loads
+
 
 class JsonProtocol(asyncio.Protocol):
     """
     Implements asyncio's Protocol pattern for transferring data in the form of line-separated json-encoded
     messages.
     """
+    __slots__ = ('transport', '__buffer')
+
     MAX_BUFSIZE = 1024*1024*20
 
     def connection_made(self, transport):
         self.transport = transport
-        self.__buffer = ''
+        self.__buffer = bytearray()
 
     def data_received(self, data):
-        decoded = data.decode()
-
-        if len(decoded) + len(self.__buffer) > JsonProtocol.MAX_BUFSIZE:
+        buffer = self.__buffer
+        if len(data) + len(buffer) > JsonProtocol.MAX_BUFSIZE:
             print("buffer too big")
-            self.__buffer = ''
+            buffer.clear()
 
-        self.__buffer += decoded
-
-        if '\n' in decoded:
-            message_str, self.__buffer = self.__buffer.split('\n', 1)
+        # the remainder of the previous call holds no separator, only the new data can contain one
+        offset = len(buffer)
+        buffer += data
+        end = buffer.find(b'\n', offset)
+        if end < 0:
+            return
 
+        # handle every complete message in the buffer
+        start = 0
+        while end >= 0:
             try:
-                obj = json.loads(message_str)
-            except json.JSONDecodeError:
+                obj = loads(buffer[start:end])
+            except ValueError:
+                # json.JSONDecodeError and orjson.JSONDecodeError are both subclasses of ValueError
                 print("error decoding message")
                 # TODO: log
             else:
                 self.received(obj)
 
+            start = end + 1
+            end = buffer.find(b'\n', start)
+
+        del buffer[:start]
+
     def send(self, obj):
-        s = json.dumps(obj) + "\n"
-        return self.transport.write(s.encode())
+        return self.transport.write(dumps(obj) + b'\n')
+
+    def send_raw(self, message: bytes):
+        """
+        Sends a message that is already json-encoded, e.g. by :func:`dumps`.
+        """
+        return self.transport.write(message + b'\n')
 
     def received(self, obj):
-        raise NotImplementedError()
\ No newline at end of file
+        raise NotImplementedError()
@@ -1,8 +1,28 @@
+from typing import Callable, Sequence
+
 from pymongo.collection import Collection, ReturnDocument
+from pymongo.errors import OperationFailure
 
 class UnknownField(Exception):
     pass
 
+
+def watch_changes(coll: Collection, pipeline: Sequence[dict], callback: Callable[[], None]):
+    """
+    Blocks and calls callback each time a change matching pipeline happens in the collection. Run it in a
+    separate thread. Returns if the server does not support change streams (they require a replica set),
+    in that case the caller has to keep polling.
+    :param coll: The collection to watch.
+    :param pipeline: Aggregation stages filtering the change events.
+    :param callback: Function without arguments called for every matching change.
+    """
+    try:
+        with coll.watch(pipeline) as stream:
+            for _ in stream:
+                callback()
+    except OperationFailure as e:
+        print("cannot watch collection {}, falling back to polling: {}".format(coll.full_name, e))
+
 class AutoIncrementFactory:
     def __init__(self, coll: Collection):
         self.coll = coll
@@ -46,6 +66,24 @@ class AutoIncrementFactory:
 
         return func
 
+    def reserve(self, field: str, count: int) -> range:
+        """
+        Atomically reserves a block of consecutive values of the given field.
+        :param field: The name of the field from which values should be reserved.
+        :param count: Number of values to reserve.
+        :raises UnknownField: if the field does not exist.
+        :return: The range of reserved values.
+        """
+        doc = self.coll.find_one_and_update(
+            {'_id': field},
+            {'$inc': {'next': count}},
+            return_document=ReturnDocument.BEFORE
+        )
+        if doc is None:
+            raise UnknownField()
+
+        return range(doc['next'], doc['next'] + count)
+
 class TypelockFactory:
     def __init__(self, coll: Collection):
         self.coll = coll
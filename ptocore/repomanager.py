@@ -52,11 +52,10 @@ def procure_repository(base_path: str, analyzer_id: str, repo_url: str, repo_com
         # delete analyzer repository
         shutil.rmtree(repo_path)
 
-    git_cmd(base_path, ['git', 'clone', repo_url, repo_path])
-
-    clean_repository(repo_path)
-    git_cmd(repo_path, ['git', 'fetch', '-q'])
-    git_cmd(repo_path, ['git', 'checkout', repo_commit])
+    # the clone is fresh, therefore there is nothing to reset, clean or fetch.
+    # the working tree is only populated once, with the requested commit.
+    git_cmd(base_path, ['git', 'clone', '-q', '--no-checkout', repo_url, repo_path])
+    git_cmd(repo_path, ['git', 'checkout', '-q', repo_commit])
 
     config_fn = os.path.join(repo_path, 'ptocore.json')
 
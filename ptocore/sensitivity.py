@@ -1,7 +1,6 @@
 from datetime import datetime, timedelta
+from operator import itemgetter
 from typing import Tuple, Sequence, Callable
-from itertools import takewhile
-from collections import OrderedDict
 
 import pymongo
 from pymongo.collection import Collection
@@ -22,6 +21,9 @@ def extend_hourly(interval: Interval) -> Interval:
 
     return start, stop
 
+_get_id_upload_ids = itemgetter('_id', 'upload_ids')
+_get_max_action_id_upload_ids = itemgetter('max_action_id', 'upload_ids')
+
 def _get_timeline(actions):
     tl = timeline.Timeline()
     for action in actions:
@@ -46,6 +48,9 @@ class ActionSetBase:
         self.output_actions = []
         self.output_max_action_id = -1
 
+        # key and result of the last call to direct()
+        self._direct_cache = None
+
     def is_direct_allowed(self):
         return len(self._input_types) == 0
 
@@ -75,30 +80,33 @@ class ActionSetBase:
         # Upon change of analyzer code, all previous invocations of analyzer module don't show up anymore in output_actions already.
         #
 
-        # get the maximum action_id (last change) and minimum action_id (upload) for each upload
-        uploads_max_action_id = OrderedDict()
-        uploads_min_action_id = OrderedDict()
-        for action in self.input_actions:
+        # the result only changes if actions are added
+        key = (self.get_max_action_id(), len(self.input_actions), len(self.output_actions))
+        if self._direct_cache is not None and self._direct_cache[0] == key:
+            return key[0], list(self._direct_cache[1])
+
+        # get the maximum action_id (last change) for each upload
+        uploads_max_action_id = {}
+        for aid, upload_ids in map(_get_id_upload_ids, self.input_actions):
             # the list upload has exactly one item
-            uid = action['upload_ids'][0]
-            aid = action['_id']
+            uid = upload_ids[0]
             if uploads_max_action_id.get(uid, -1) < aid:
                 uploads_max_action_id[uid] = aid
 
-            if action['action'] == 'upload':
-                uploads_min_action_id[uid] = aid
-
-        # for each upload determine if it has been analyzed
-        uploads_processed = []
-        for upload_id, upload_max_action_id in uploads_max_action_id.items():
-            for analysis in self.output_actions:
-                if analysis['max_action_id'] >= upload_max_action_id and upload_id in analysis['upload_ids']:
-                    uploads_processed.append(upload_id)
-                    break
+        # get the highest max_action_id of all analyses of each upload
+        uploads_analyzed_action_id = {}
+        for aid, upload_ids in map(_get_max_action_id_upload_ids, self.output_actions):
+            for uid in upload_ids:
+                if uploads_analyzed_action_id.get(uid, aid) <= aid:
+                    uploads_analyzed_action_id[uid] = aid
 
-        uploads_unprocessed = [upload_id for upload_id in uploads_max_action_id if upload_id not in uploads_processed]
+        # an upload has been processed if it was analyzed after its last change
+        uploads_unprocessed = [upload_id for upload_id, upload_max_action_id in uploads_max_action_id.items()
+                               if not (upload_id in uploads_analyzed_action_id and
+                                       uploads_analyzed_action_id[upload_id] >= upload_max_action_id)]
 
-        return self.get_max_action_id(), uploads_unprocessed
+        self._direct_cache = (key, uploads_unprocessed)
+        return key[0], list(uploads_unprocessed)
 
     def basic(self) -> Tuple[int, Sequence[Interval]]:
 
@@ -166,31 +174,41 @@ class ActionSetMongo(ActionSetBase):
 
         super().__init__(input_formats, input_types)
 
-        self._load_input_actions(input_types, input_formats, action_log)
-        self._load_output_actions(analyzer_id, git_url, git_commit, action_log)
+        self._load_actions(analyzer_id, git_url, git_commit, input_types, input_formats, action_log)
 
-    def _load_input_actions(self, input_types, input_formats, action_log):
+    def _load_actions(self, analyzer_id, git_url, git_commit, input_types, input_formats, action_log: Collection):
+        # input and output actions are loaded with one query and told apart afterwards.
         query = {
             '$or': [
                 {'output_types': {'$in': input_types}},
-                {'output_formats': {'$in': input_formats}}
+                {'output_formats': {'$in': input_formats}},
+                {'analyzer_id': analyzer_id}
             ]
         }
+        proj = {'_id': 1, 'action': 1, 'timespans': 1, 'upload_ids': 1, 'output_types': 1, 'output_formats': 1,
+                'analyzer_id': 1, 'git_url': 1, 'git_commit': 1, 'max_action_id': 1}
 
-        result = action_log.find(query, {'action': 1, 'timespans': 1, 'upload_ids': 1}).sort([('_id', pymongo.DESCENDING)])
-        self.input_actions = list(result)
+        input_types = set(input_types)
+        input_formats = set(input_formats)
 
-        self.input_max_action_id = self.input_actions[0]['_id'] if len(self.input_actions) > 0 else -1
-
-    def _load_output_actions(self, analyzer_id, git_url, git_commit, action_log: Collection):
-        query = {'analyzer_id': analyzer_id}
-        proj = {'_id': 1, 'git_url': 1, 'git_commit': 1, 'timespans': 1, 'upload_ids': 1, 'max_action_id': 1}
-
-        def same_code(doc):
-            return doc['git_url'] == git_url and doc['git_commit'] == git_commit
+        self.input_actions = []
+        self.output_actions = []
+        same_code = True
+        for doc in action_log.find(query, proj).sort([('_id', pymongo.DESCENDING)]):
+            if not input_types.isdisjoint(doc.get('output_types', ())) or \
+                    not input_formats.isdisjoint(doc.get('output_formats', ())):
+                self.input_actions.append({key: doc[key] for key in ('_id', 'action', 'timespans', 'upload_ids')
+                                           if key in doc})
+
+            # only consider the latest runs of the analyzer that used the current code
+            if same_code and doc.get('analyzer_id') == analyzer_id:
+                same_code = doc['git_url'] == git_url and doc['git_commit'] == git_commit
+                if same_code:
+                    self.output_actions.append({key: doc[key] for key in
+                                                ('_id', 'git_url', 'git_commit', 'timespans', 'upload_ids',
+                                                 'max_action_id') if key in doc})
 
-        result = action_log.find(query, proj).sort([('_id', pymongo.DESCENDING)])
-        self.output_actions = list(takewhile(same_code, result))
+        self.input_max_action_id = self.input_actions[0]['_id'] if len(self.input_actions) > 0 else -1
 
         # this is the maximum action_id known prior to executing the analyzer. why not just the _id?
         # note that the validator assigns the action_id after execution of the analyzer.
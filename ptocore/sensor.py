@@ -35,6 +35,14 @@ class Sensor:
         logger = logging.getLogger('sensor')
 
         logger.info("check for work")
+
+        # the types are determined once per check. only this loop changes the set of running analyzers in the
+        # meantime, it updates the sets itself. analyzers finishing concurrently are picked up by the next check.
+        blocked_types = self.analyzer_state.blocked_types()
+        unstable_types = self.analyzer_state.unstable_types()
+        logger.debug("blocked_types: {}".format(str(blocked_types)))
+        logger.debug("unstable_types: {}".format(str(unstable_types)))
+
         sensing = self.analyzer_state.sensing_analyzers()
         for analyzer in sensing:
             # check for wishes
@@ -49,14 +57,10 @@ class Sensor:
             logger.debug("check situation for {}: input_formats={}, input_types={}"
                          .format(analyzer['_id'],analyzer['input_formats'], analyzer['input_types']))
             # check types
-            blocked_types = self.analyzer_state.blocked_types()
-            logger.debug("blocked_types: {}".format(str(blocked_types)))
             if any(output_type in blocked_types for output_type in analyzer['output_types']):
                 # TODO set 'stalled_reason' = "output blocked" in analyzers_coll
                 continue
 
-            unstable_types = self.analyzer_state.unstable_types()
-            logger.debug("unstable_types: {}".format(str(unstable_types)))
             if any(input_type in unstable_types for input_type in analyzer['input_types']):
                 # TODO set 'stalled_reason' = "input unstable" in analyzers_coll
                 continue
@@ -79,6 +83,8 @@ class Sensor:
                 self.analyzer_state.transition(analyzer['_id'], 'sensing', 'planned')
 
                 # the input types and output types specified in the analyzer are now blocked
+                blocked_types.update(analyzer['input_types'])
+                unstable_types.update(analyzer['output_types'])
 
 
 def main():
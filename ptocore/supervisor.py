@@ -1,44 +1,127 @@
 import asyncio
+import hmac
 import json
 import traceback
 import argparse
 import logging
-from typing import Tuple
+from typing import List, Tuple, Union
 
 import os
+import sys
+import threading
 from functools import partial
+from secrets import token_hex
+from concurrent.futures import ThreadPoolExecutor
 import dpath.util
+from pymongo.errors import ConnectionFailure
 
 from .agent import AgentBase, OnlineAgent, ModuleAgent
-from .analyzerstate import AnalyzerState
-from .jsonprotocol import JsonProtocol
-from .mongoutils import AutoIncrementFactory
+from .analyzerstate import AnalyzerState, TransitionFailed
+from .jsonprotocol import JsonProtocol, dumps
+from .mongoutils import AutoIncrementFactory, watch_changes
 from .coreconfig import CoreConfig
 
+# error answers which are sent often, e.g. to misconfigured clients, are encoded once
+ERROR_NOT_AN_OBJECT = dumps({'error': 'request must be an object'})
+ERROR_UNKNOWN_IDENTIFIER = dumps({'error': 'authentication failed, analyzer not on record with this identifier'})
+ERROR_TOKEN_INCORRECT = dumps({'error': 'authentication failed, token incorrect'})
+ERROR_AUTHENTICATION_FAILED = dumps({'error': 'authentication failed'})
+
 
 class SupervisorServer(JsonProtocol):
     """
     Adapter class for asyncio's protocol implementing the server side.
+
+    A client may authenticate once per connection by sending {'hello': identifier, 'token': token}. Subsequent
+    requests on this connection then only need the fields action and payload. Requests carrying identifier and
+    token are authenticated individually as before.
+
+    If a request carries the field request_id, it is copied to the answer.
     """
+    __slots__ = ('supervisor', 'agent')
+
     def __init__(self, supervisor):
         self.supervisor = supervisor
 
+        # the agent bound to this connection by the hello message
+        self.agent = None
+
     def connection_made(self, transport):
         super().connection_made(transport)
 
     def received(self, obj):
+        if not isinstance(obj, dict):
+            self.send_raw(ERROR_NOT_AN_OBJECT)
+            return
+
+        ans = self._answer(obj)
+
+        if isinstance(ans, bytes):
+            # already encoded answer, the request id is put in front of its fields
+            if 'request_id' in obj:
+                ans = b'{"request_id":' + dumps(obj['request_id']) + b',' + ans[1:]
+            self.send_raw(ans)
+            return
+
+        # echo the request id so that the client can match answers to requests
+        if 'request_id' in obj:
+            ans = dict(ans, request_id=obj['request_id'])
+
+        self.send(ans)
+
+    def _answer(self, obj) -> Union[dict, bytes]:
+        if 'hello' in obj:
+            return self._hello(obj)
+
+        if self.agent is not None and 'identifier' not in obj:
+            # the agent may have been torn down since the hello message
+            if self.supervisor.agents.get(self.agent.identifier) is not self.agent:
+                self.agent = None
+                return ERROR_UNKNOWN_IDENTIFIER
+
+            try:
+                action = obj['action']
+                payload = obj['payload']
+            except KeyError:
+                return {'error': 'request is missing one or more fields: {action, payload}'}
+
+            if not isinstance(action, str):
+                return {'error': 'field action must be a string'}
+
+            return self.agent._handle_request(action, payload)
+
         try:
-            identifier = str(obj['identifier'])
-            token = str(obj['token'])
-            action = str(obj['action'])
+            identifier = obj['identifier']
+            token = obj['token']
+            action = obj['action']
             payload = obj['payload']
         except KeyError:
             print("request is missing one or more fields: {token, identifier, action, payload}")
-            self.send({'error': 'request is missing one or more fields: {token, identifier, action, payload}'})
-            return
+            return {'error': 'request is missing one or more fields: {token, identifier, action, payload}'}
 
-        ans = self.supervisor._analyzer_request(identifier, token, action, payload)
-        self.send(ans)
+        if not (isinstance(identifier, str) and isinstance(token, str) and isinstance(action, str)):
+            return {'error': 'fields identifier, token and action must be strings'}
+
+        return self.supervisor._analyzer_request(identifier, token, action, payload)
+
+    def _hello(self, obj) -> Union[dict, bytes]:
+        """
+        Binds the agent to this connection if the credentials are correct.
+        """
+        try:
+            identifier = obj['hello']
+            token = obj['token']
+        except KeyError:
+            return {'error': 'hello is missing the field token'}
+
+        if not (isinstance(identifier, str) and isinstance(token, str)):
+            return {'error': 'fields hello and token must be strings'}
+
+        self.agent = self.supervisor._authenticate(identifier, token)
+        if self.agent is None:
+            return ERROR_AUTHENTICATION_FAILED
+        else:
+            return {'hello': True}
 
 
 class Supervisor:
@@ -63,13 +146,29 @@ class Supervisor:
         self._delete_temp_users()
 
         # the supervisor is the only component generating agent_ids, therefore create_if_missing=True is not a problem.
-        idfactory = AutoIncrementFactory(self.core_config.idfactory_coll)
-        self._agent_id_creator = idfactory.get_incrementor('agent_id', create_if_missing=True)
+        self._idfactory = AutoIncrementFactory(self.core_config.idfactory_coll)
+        self._agent_id_creator = self._idfactory.get_incrementor('agent_id', create_if_missing=True)
 
         self.analyzer_state = AnalyzerState('supervisor', self.core_config.analyzers_coll)
 
         self.agents = {}
 
+        # identifier -> (encoded token, request handler) of every agent in self.agents
+        self._handlers = {}
+
+        # bounds the number of analyzer modules executing at the same time
+        self._execute_slots = asyncio.Semaphore(self.core_config.supervisor_max_concurrent)
+
+        # set when there might be new work
+        self._wakeup = asyncio.Event()
+
+        # state transitions of finished analyzers that are written in bulk by _flush_transitions
+        self._transitions = []
+
+        # agents are provisioned and torn down in the default executor. these are mostly waiting for MongoDB,
+        # therefore allow more threads than cores.
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)))
+
         self.server = None
 
         server_coro = self.loop.create_server(lambda: SupervisorServer(self),
@@ -111,73 +210,107 @@ class Supervisor:
             self.logger.info("dropping role {}".format(rolename))
             temp_db.command("dropRole", rolename)
 
-    def _analyzer_request(self, identifier: str, token: str, action: str, payload: dict) -> dict:
+    def _create_credentials(self, prefix: str, agent_id: int=None) -> Tuple[str, str]:
+        """
+        Creates a new identifier with the given prefix and a random token for an agent.
+        :param agent_id: A previously reserved agent id, if None a new one is taken from the database.
+        """
+        if agent_id is None:
+            agent_id = self._agent_id_creator()
+        # interned because identifiers are the keys of agents and _handlers, and are looked up on every request
+        return sys.intern(prefix + str(agent_id)), token_hex(16)
+
+    def _analyzer_request(self, identifier: str, token: str, action: str, payload: dict) -> Union[dict, bytes]:
         """
         Dispatches an incoming analyzer request to the responsible agent.
         :param identifier: Username of the module or online analyzer.
         :param token: Authentication token.
         :param action: Request parameter interpreted by agent.
         :param payload: Request parameter interpreted by agent.
-        :return: Response message
+        :return: Response message, or an already encoded error message
         """
-        try:
-            agent = self.agents[identifier]
-        except KeyError:
+        entry = self._handlers.get(identifier)
+        if entry is None:
             self.logger.info("no analyzer with this identifier")
-            return {'error': 'authentication failed, analyzer not on record with this identifier'}
+            return ERROR_UNKNOWN_IDENTIFIER
 
-        if agent.token == token:
-            return agent._handle_request(action, payload)
+        # constant time comparison
+        agent_token, handler = entry
+        if hmac.compare_digest(agent_token, token.encode()):
+            return handler(action, payload)
         else:
-            return {'error': 'authentication failed, token incorrect'}
+            return ERROR_TOKEN_INCORRECT
 
-    def shutdown_online_agent(self, agent: AgentBase):
+    def _authenticate(self, identifier: str, token: str) -> AgentBase:
         """
-        Withdraw access to the observatory and delete agent.
+        :return: The agent with the given identifier if the token is correct, otherwise None.
         """
-        agent.teardown()
-        del self.agents[agent.identifier]
+        entry = self._handlers.get(identifier)
+        if entry is not None and hmac.compare_digest(entry[0], token.encode()):
+            return self.agents[identifier]
+
+        self.logger.info("authentication failed for {}".format(identifier))
+        return None
+
+    def _add_agent(self, agent: AgentBase):
+        self.agents[agent.identifier] = agent
+        self._handlers[agent.identifier] = (agent.token.encode(), agent._handle_request)
+
+    def _remove_agent(self, agent: AgentBase):
+        self.agents.pop(agent.identifier, None)
+        self._handlers.pop(agent.identifier, None)
 
-    def create_online_agent(self) -> Tuple[dict, OnlineAgent]:
+    async def shutdown_online_agent(self, agent: AgentBase):
         """
-        Create an online agent and return credentials for use with :class:`.analyzercontext.AnalyzerContext`
+        Coroutine which withdraws access to the observatory and deletes the agent.
+        """
+        await self.loop.run_in_executor(None, agent.teardown)
+        self._remove_agent(agent)
+
+    async def create_online_agent(self) -> Tuple[dict, OnlineAgent]:
+        """
+        Coroutine which creates an online agent and return credentials for use with :class:`.analyzercontext.AnalyzerContext`
         :return: A two-tuple consisting of credentials (a dict with the keys 'identifier', 'token', 'host', 'port')
         and a reference to the responsible agent.
         """
         self.logger.info("creating online supervisor")
 
         # create agent
-        identifier = 'online_'+str(self._agent_id_creator())
-        token = os.urandom(16).hex()
+        identifier, token = self._create_credentials('online_')
 
-        agent = OnlineAgent(identifier, token, self.core_config)
+        agent = await OnlineAgent.create(identifier, token, self.core_config, loop=self.loop)
 
-        self.agents[agent.identifier] = agent
+        self._add_agent(agent)
 
         credentials = { 'identifier': agent.identifier, 'token': token,
                         'host': 'localhost', 'port': self.core_config.supervisor_port }
 
         return credentials, agent
 
-    def _script_agent_done(self, agent: ModuleAgent, fut: asyncio.Future):
+    async def _run_module_agent(self, agent: ModuleAgent):
         """
-        Future callback that checks if any errors happened while executing the analyzer module and if no errors were
-        encountered passes the analyzer module to the validator.
+        Coroutine which executes the analyzer module as soon as one of the execution slots is free, tears down the
+        agent, checks if any errors happened while executing the analyzer module and if no errors were encountered
+        passes the analyzer module to the validator.
+        The teardown is executed in the default executor, the state transition is queued for :func:`_flush_transitions`.
         """
-        self.logger.info("module agent done")
-        agent.teardown()
-        del self.agents[agent.identifier]
-
         try:
-            # raise exceptions that happened in the future
-            fut.result()
-        except Exception as e:
+            async with self._execute_slots:
+                await agent.execute()
+        except Exception:
             # an error happened
             traceback.print_exc()
+            error = traceback.format_exc()
+        else:
+            error = None
+
+        self.logger.info("module agent done")
+        await self._teardown_module_agent(agent)
 
+        if error is not None:
             # set state accordingly
-            self.analyzer_state.transition_to_error(agent.analyzer_id,
-                                                     "error when exeucting analyzer module:\n" + traceback.format_exc())
+            self._queue_transition(self.analyzer_state.transition_to_error_op(
+                agent.analyzer_id, "error when exeucting analyzer module:\n" + error))
         else:
             # everything went well, so give to validator
             transition_args = {'execution_result': {
@@ -187,49 +320,198 @@ class Supervisor:
                 'upload_ids': agent.result_upload_ids   # None when normal analyzer
             }}
 
-            self.analyzer_state.transition(agent.analyzer_id, 'executing', 'executed', transition_args)
+            self._queue_transition(self.analyzer_state.transition_op(
+                agent.analyzer_id, 'executing', 'executed', transition_args))
 
-    def check_for_work(self):
+        # the finished analyzer frees an execution slot, look for work right away
+        self._wakeup.set()
+
+    async def _teardown_module_agent(self, agent: ModuleAgent, discard: bool=False):
         """
-        Scans the analyzers collection for planned analyzers and executes them.
+        Coroutine which removes the agent and withdraws its access to the observatory in the default executor.
+        A failed teardown is only logged, remnant users and roles are deleted at the next start of the supervisor.
+        :param discard: True if the analyzer module never ran, its temporary collection is deleted as well.
         """
-        planned = self.analyzer_state.planned_analyzers()
-        self.logger.debug("check for work")
-        for analyzer in planned:
+        self._remove_agent(agent)
+        try:
+            await self.loop.run_in_executor(None, agent.discard if discard else agent.teardown)
+        except Exception:
+            self.logger.exception("teardown of agent {} failed".format(agent.identifier))
+
+    def _queue_transition(self, op):
+        """
+        Queues a state transition and schedules :func:`_flush_transitions` if it is the first one queued.
+        """
+        self._transitions.append(op)
+        if len(self._transitions) == 1:
+            asyncio.ensure_future(self._flush_transitions(), loop=self.loop)
+
+    async def _flush_transitions(self, delay: float=0.1):
+        """
+        Coroutine which waits a moment for more analyzers to finish and then writes all queued state transitions
+        with a single bulk write in the default executor.
+        """
+        await asyncio.sleep(delay)
+        ops, self._transitions = self._transitions, []
+
+        try:
+            await self.loop.run_in_executor(None, self.analyzer_state.bulk_transition, ops)
+        except TransitionFailed as e:
+            # all updates were written, some analyzers had left executing state in the meantime
+            self.logger.warning("writing state transitions of finished analyzers: {}".format(e))
+        except Exception:
+            self.logger.exception("writing state transitions of finished analyzers failed, writing them one by one")
+
+            # unless the single writes report otherwise, all transitions are queued again. the transitions only
+            # match analyzers in the expected state, therefore retrying them is safe.
+            retry = ops
+            try:
+                retry = await self.loop.run_in_executor(None, self._write_transitions, ops)
+            except Exception:
+                self.logger.exception("writing state transitions one by one failed, retrying all of them")
+            finally:
+                for op in retry:
+                    self._queue_transition(op)
+
+    def _write_transitions(self, ops: List) -> List:
+        """
+        Writes the state transitions one by one, so that a failing transition does not affect the others.
+        Blocking, run it in the executor.
+        :return: The transitions that failed because the database was unreachable and should be retried.
+        """
+        for idx, op in enumerate(ops):
+            try:
+                self.analyzer_state.bulk_transition([op])
+            except TransitionFailed:
+                pass
+            except ConnectionFailure:
+                self.logger.warning("database unreachable, retrying {} state transitions".format(len(ops) - idx))
+                return ops[idx:]
+            except Exception:
+                self.logger.exception("writing state transition {} failed".format(op))
+
+        return []
+
+    async def _create_module_agent(self, analyzer: dict, agent_id: int) -> ModuleAgent:
+        """
+        Coroutine which creates the module agent for the given analyzer.
+        :param agent_id: The reserved agent id for the identifier of the agent.
+        """
+        self.logger.info("execute analyzer {}".format(analyzer['_id']))
+
+        # create agent
+        identifier, token = self._create_credentials('module_', agent_id)
+
+        agent = await ModuleAgent.create(analyzer['_id'], identifier, token, self.core_config,
+                                         analyzer['input_formats'], analyzer['input_types'],
+                                         analyzer['output_types'], analyzer['command_line'],
+                                         analyzer['working_dir'], self.core_config.supervisor_ensure_clean_repo,
+                                         loop=self.loop)
+
+        self._add_agent(agent)
+        return agent
+
+    def _planned_analyzers(self) -> List[dict]:
+        """
+        Returns the planned analyzers that should be executed and cancels those with a cancel wish.
+        Blocking, run it in the executor.
+        """
+        planned = []
+        for analyzer in self.analyzer_state.planned_analyzers():
             # check for wish
             # TODO also check wish for executing analyzers
             if self.analyzer_state.check_wish(analyzer, 'cancel'):
                 self.logger.info("cancel analyzer {} upon request".format(analyzer['_id']))
                 continue
 
-            self.logger.info("execute analyzer {}".format(analyzer['_id']))
-
-            # create agent
-            identifier = 'module_'+str(self._agent_id_creator())
-            token = os.urandom(16).hex()
+            planned.append(analyzer)
 
-            agent = ModuleAgent(analyzer['_id'], identifier, token, self.core_config,
-                                analyzer['input_formats'], analyzer['input_types'], analyzer['output_types'],
-                                analyzer['command_line'], analyzer['working_dir'],
-                                self.core_config.supervisor_ensure_clean_repo)
+        return planned
 
-            self.agents[agent.identifier] = agent
-
-            # change analyzer state
-            self.analyzer_state.transition(agent.analyzer_id, 'planned', 'executing')
+    def _start_executing(self, agents: List[ModuleAgent]) -> List[bool]:
+        """
+        Changes the state of the analyzer of each agent from planned to executing.
+        Blocking, run it in the executor.
+        :return: For each agent whether the transition succeeded.
+        """
+        started = []
+        for agent in agents:
+            try:
+                self.analyzer_state.transition(agent.analyzer_id, 'planned', 'executing')
+            except TransitionFailed as e:
+                self.logger.info("not executing analyzer {}: {}".format(agent.analyzer_id, e))
+                started.append(False)
+            else:
+                started.append(True)
+
+        return started
+
+    async def check_for_work(self):
+        """
+        Coroutine which scans the analyzers collection for planned analyzers and executes them.
+        The agents of all planned analyzers are provisioned concurrently. At most supervisor_max_concurrent analyzer
+        modules execute at the same time, the others wait in executing state for a free slot.
+        """
+        self.logger.debug("check for work")
+        planned = await self.loop.run_in_executor(None, self._planned_analyzers)
+        if len(planned) == 0:
+            return
 
-            # schedule for execution
-            task = asyncio.ensure_future(agent.execute())
-            task.add_done_callback(partial(self._script_agent_done, agent))
-            self.logger.info("module agent started")
+        # reserve the agent ids of all planned analyzers at once
+        agent_ids = await self.loop.run_in_executor(None, self._idfactory.reserve, 'agent_id', len(planned))
+
+        results = await asyncio.gather(*(self._create_module_agent(analyzer, agent_id)
+                                         for analyzer, agent_id in zip(planned, agent_ids)),
+                                       return_exceptions=True)
+
+        # analyzers whose agent could not be created are put into error state, the others are executed
+        agents = []
+        error_ops = []
+        for analyzer, result in zip(planned, results):
+            if isinstance(result, BaseException):
+                self.logger.error("creating agent for analyzer {} failed: {!r}".format(analyzer['_id'], result))
+                error = ''.join(traceback.format_exception(type(result), result, result.__traceback__))
+                error_ops.append(self.analyzer_state.transition_to_error_op(
+                    analyzer['_id'], "error when creating agent:\n" + error))
+            else:
+                agents.append(result)
+
+        if len(error_ops) > 0:
+            try:
+                await self.loop.run_in_executor(None, self.analyzer_state.bulk_transition, error_ops)
+            except Exception:
+                self.logger.exception("writing error state of analyzers without agent failed")
+
+        # change analyzer states
+        started = await self.loop.run_in_executor(None, self._start_executing, agents)
+
+        # schedule for execution. agents of analyzers that left planned state in the meantime are discarded.
+        for agent, ok in zip(agents, started):
+            if ok:
+                asyncio.ensure_future(self._run_module_agent(agent), loop=self.loop)
+                self.logger.info("module agent started")
+            else:
+                asyncio.ensure_future(self._teardown_module_agent(agent, discard=True), loop=self.loop)
 
     async def run(self):
         """
         Convenience coroutine to run the supervisor.
+
+        Wakes up as soon as an analyzer is planned. Polling is kept as fallback in case change streams are not
+        available (e.g. no replica set) or an event was missed.
         """
+        pipeline = [{'$match': {'operationType': 'update', 'updateDescription.updatedFields.state': 'planned'}}]
+        threading.Thread(target=watch_changes, daemon=True,
+                         args=(self.core_config.analyzers_coll, pipeline,
+                               partial(self.loop.call_soon_threadsafe, self._wakeup.set))).start()
+
         while True:
-            self.check_for_work()
-            await asyncio.sleep(4)
+            await self.check_for_work()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), 4)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
 
 
 def main():
@@ -242,12 +524,21 @@ def main():
 
     logging.basicConfig(level=logging.DEBUG)
 
-    loop = asyncio.get_event_loop()
+    # uvloop is optional, it speeds up the subprocess pipes and the server socket.
+    try:
+        import uvloop
+    except ImportError:
+        logging.getLogger('supervisor').info("uvloop not installed, using default event loop")
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
 
     sup = Supervisor(cc, loop)
 
     # create online supervisor and print account details
-    credentials, agent = sup.create_online_agent()
+    credentials, agent = loop.run_until_complete(sup.create_online_agent())
     print(json.dumps(credentials))
     print("export PTO_CREDENTIALS=\"{}\"".format(json.dumps(credentials).replace('"', '\\"')))
 
@@ -1,4 +1,6 @@
+from bisect import bisect_left
 from itertools import chain
+from typing import Tuple
 
 def merge(int1, int2):
     a, b = int1
@@ -43,46 +45,100 @@ def subtract(int1, int2):
 
 
 class Timeline:
+    __slots__ = ('_intervals', '_begins', '_ends')
+
     def __init__(self, intervals = None):
+        # the intervals in the order they were added, a merged interval counts as added last. the begins and ends of
+        # the same intervals are kept sorted in _begins and _ends to find the overlapping ones by bisection.
         if intervals is not None:
-            self.intervals = intervals.copy()
+            # intervals are stored as tuples, also if given as lists (e.g. timespans from bson)
+            self._intervals = dict.fromkeys((a, b) for a, b in intervals)
         else:
-            self.intervals = []
+            self._intervals = {}
+        self._sort()
+
+    def _sort(self):
+        intervals = sorted(self._intervals)
+        self._begins = [a for a, b in intervals]
+        self._ends = [b for a, b in intervals]
+
+    def _overlapping(self, a, b) -> Tuple[int, int]:
+        """
+        Returns the index range in _begins and _ends of the intervals overlapping or touching (a, b). The intervals
+        do not overlap (but may touch after remove_interval), so these are consecutive in sorted order.
+        """
+        begins = self._begins
+        ends = self._ends
+
+        lo = hi = bisect_left(begins, a)
+        while lo > 0 and ends[lo - 1] >= a:
+            lo -= 1
+            a = begins[lo]
+            b = max(b, ends[lo])
+
+        while hi < len(begins) and begins[hi] <= b:
+            b = max(b, ends[hi])
+            hi += 1
+
+        return lo, hi
+
+    def copy(self) -> 'Timeline':
+        """
+        Returns a copy of this timeline without sorting the intervals again.
+        """
+        ret = Timeline.__new__(Timeline)
+        ret._intervals = self._intervals.copy()
+        ret._begins = self._begins.copy()
+        ret._ends = self._ends.copy()
+        return ret
+
+    @property
+    def intervals(self):
+        return list(self._intervals)
 
     def add_interval(self, a, b):
         assert(a <= b)
 
-        candidate = (a, b)
-        while True:
-            for interval in self.intervals:
-                merged = merge(candidate, interval)
-                if merged is not None:
-                    self.intervals.remove(interval)
-                    candidate = merged
-                    break
-            else:
-                self.intervals.append(candidate)
-                break
+        lo, hi = self._overlapping(a, b)
+
+        # grow (a, b) to cover all the overlapping intervals and replace them
+        if lo < hi:
+            a = min(a, self._begins[lo])
+            b = max(b, max(self._ends[lo:hi]))
+            for interval in zip(self._begins[lo:hi], self._ends[lo:hi]):
+                del self._intervals[interval]
+
+        self._begins[lo:hi] = [a]
+        self._ends[lo:hi] = [b]
+        self._intervals[(a, b)] = None
 
     def remove_interval(self, a, b):
         assert(a <= b)
 
         candidate = (a, b)
-        self.intervals = list(chain.from_iterable(subtract(interval, candidate) for interval in self.intervals))
+        self._intervals = dict.fromkeys(chain.from_iterable(subtract(interval, candidate)
+                                                            for interval in self._intervals))
+        self._sort()
 
     def is_empty(self):
-        return len(self.intervals) == 0
+        return len(self._intervals) == 0
 
     def __sub__(self, tl):
-        ret = Timeline(self.intervals)
-        for a, b in tl.intervals:
-            ret.remove_interval(a, b)
+        remaining = []
+        for interval in self._intervals:
+            # only the intervals of tl overlapping or touching this one can change it
+            lo, hi = tl._overlapping(*interval)
 
-        return ret
+            pieces = [interval]
+            for other in zip(tl._begins[lo:hi], tl._ends[lo:hi]):
+                pieces = list(chain.from_iterable(subtract(piece, other) for piece in pieces))
+            remaining.extend(pieces)
+
+        return Timeline(remaining)
 
     def __add__(self, tl):
-        ret = Timeline(self.intervals)
-        for a, b in tl.intervals:
+        ret = self.copy()
+        for a, b in tl._intervals:
             ret.add_interval(a, b)
 
         return ret
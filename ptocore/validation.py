@@ -1,15 +1,16 @@
 from datetime import datetime
 from typing import Sequence, Tuple
 
-from bson import CodecOptions
-from collections import OrderedDict
 from pymongo.collection import Collection
 
-VALIDATION_COMPARE_FIELDS = {'conditions', 'time', 'path', 'value', 'sources', 'analyzer_id'}
+VALIDATION_COMPARE_FIELDS = frozenset({'conditions', 'time', 'path', 'value', 'sources', 'analyzer_id'})
 
-VALIDATION_INPUT_FIELDS = {'conditions', 'time', 'path', 'value', 'sources', '_id'}
+VALIDATION_INPUT_FIELDS = frozenset({'conditions', 'time', 'path', 'value', 'sources', '_id'})
 
-VALIDATION_OUTPUT_FIELDS = VALIDATION_COMPARE_FIELDS | {'action_ids', 'valid'}
+VALIDATION_OUTPUT_FIELDS = VALIDATION_COMPARE_FIELDS | frozenset({'action_ids', 'valid'})
+
+# the same fields as list, ready to be embedded into aggregation expressions
+VALIDATION_INPUT_FIELDS_LIST = sorted(VALIDATION_INPUT_FIELDS)
 
 COMPARE_PROJECTION = {'_id': 0, 'conditions': 1, 'path': 1, 'analyzer_id': 1, 'sources': 1, 'value': 1}
 
@@ -24,18 +25,67 @@ class ValidationError(Exception):
         return "Validation Error {}: {} {}".format(self.obsid, self.reason, self.extra)
 
 
-codec_opts = CodecOptions(document_class=OrderedDict)
-
-
-def collection_ensure_order(coll: Collection):
-    return coll.with_options(codec_options=codec_opts)
-
-
 def check(cond, obsid, reason: str, extra: str=''):
     if not cond:
         raise ValidationError(obsid, reason, extra)
 
 
+def timespan_expr(timespans: Sequence[Tuple[datetime, datetime]]) -> dict:
+    """
+    Aggregation expression which is true if the field time (a date or an object with the dates from and to) lies
+    within any of the given timespans. Milliseconds are ignored.
+    """
+    def truncate(field):
+        return {'$subtract': [field, {'$millisecond': field}]}
+
+    def within(start, stop):
+        return {'$or': [{'$and': [{'$lte': [timespan[0], start]},
+                                  {'$lte': [start, stop]},
+                                  {'$lte': [stop, timespan[1]]}]}
+                        for timespan in timespans]}
+
+    return {'$switch': {
+        'branches': [
+            {'case': {'$eq': [{'$type': '$time'}, 'date']},
+             'then': within(truncate('$time'), truncate('$time'))},
+            {'case': {'$and': [{'$eq': [{'$type': '$time'}, 'object']},
+                               {'$eq': [{'$type': '$time.from'}, 'date']},
+                               {'$eq': [{'$type': '$time.to'}, 'date']}]},
+             'then': within(truncate('$time.from'), truncate('$time.to'))}
+        ],
+        'default': False
+    }}
+
+
+def validation_error_expr(timespans: Sequence[Tuple[datetime, datetime]], output_types: Sequence[str]) -> dict:
+    """
+    Aggregation expression which evaluates to the reason why a document is invalid or to null if it is valid.
+    The checks are evaluated in order, the first failing check determines the reason.
+    """
+    keys = {'$map': {'input': {'$objectToArray': '$$ROOT'}, 'in': '$$this.k'}}
+
+    return {'$switch': {
+        'branches': [
+            # check that it has the correct fieldnames
+            {'case': {'$not': [{'$setEquals': [keys, {'$literal': VALIDATION_INPUT_FIELDS_LIST}]}]},
+             'then': 'wrong fields'},
+            # check that conditions are defined in output_types
+            {'case': {'$not': [{'$isArray': '$conditions'}]},
+             'then': 'conditions field is not a list'},
+            {'case': {'$not': [{'$setIsSubset': ['$conditions', {'$literal': list(output_types)}]}]},
+             'then': 'condition(s) not declared in output_types'},
+            # check that time is within any timespan
+            {'case': {'$not': [timespan_expr(timespans)]},
+             'then': 'timespan'},
+            {'case': {'$not': [{'$isArray': '$path'}]},
+             'then': 'path field is not a list'},
+            {'case': {'$ne': [{'$type': '$sources'}, 'object']},
+             'then': 'sources field is not a dict'}
+        ],
+        'default': None
+    }}
+
+
 def validate(
         analyzer_id,
         timespans: Sequence[Tuple[datetime, datetime]],
@@ -59,55 +109,44 @@ def validate(
     except (KeyError, TypeError) as e:
         return 0, [(None, str(e))]
 
-    temporary_ocoll = collection_ensure_order(temporary_coll)
-
-    valid_count = 0
-    # TODO optimize
-    for doc in temporary_ocoll.find():
-        obsid = doc['_id']
-
-        try:
-            # check that it has the correct fieldnames
-            check(doc.keys() == VALIDATION_INPUT_FIELDS, obsid, 'wrong fields', 'expected {}, got {}'.format(VALIDATION_INPUT_FIELDS, doc.keys()))
-
-            # check that conditions are defined in output_types
-            conditions = doc['conditions']
-            check(all(condition in output_types for condition in conditions), obsid,
-                  'condition(s) not declared in output_types', 'expected all of {} to be in {}'.format(conditions, output_types))
-
-            # check that time is within any timespan
-            time = doc['time']
-            if isinstance(time, dict):
-                time['from'] = time['from'].replace(microsecond = 0)
-                time['to'] = time['to'].replace(microsecond = 0)
-                check(any(timespan[0] <= time['from'] <= time['to'] <= timespan[1] for timespan in timespans), obsid, 'timespan')
-            else:
-                time = time.replace(microsecond = 0)
-                check(any(timespan[0] <= time <= timespan[1] for timespan in timespans), obsid, 'timespan')
-
-            # check that path consists only of valid path elements
-            check(isinstance(doc['path'], list), obsid, 'path field is not a list')
-            # TODO
-
-            # check that sources exist
-            # TODO and that either 'obs' or 'upl' or both exists with a list with length > 0
-            check(isinstance(doc['sources'], dict), obsid, 'sources field is not a dict')
-            # TODO in case of direct analyzer make sure that the field sources only contains the elements declared in the execution_result
-
-            # check that value is valid
-            # TODO
-            #check(valuechecks.checks[condition](doc['value']), obsid, 'value')
-
-            valid_count += 1
-        except ValidationError as e:
-            errors.append((e.obsid, e.reason, e.extra))
-
-            if len(errors) > abort_max_errors:
-                break
-        except (KeyError, TypeError) as e:
-            errors.append((None, str(e), repr(e)))
-
-            if len(errors) > abort_max_errors:
-                break
-
-    return valid_count, errors
\ No newline at end of file
+    # the documents are checked server-side, only the reasons of invalid documents are sent back.
+    pipeline = [
+        {'$addFields': {'_validation_error': validation_error_expr(timespans, output_types)}},
+        {'$facet': {
+            'invalid': [
+                {'$match': {'_validation_error': {'$ne': None}}},
+                {'$limit': abort_max_errors + 1},
+                {'$project': {
+                    '_validation_error': 1,
+                    'conditions': 1,
+                    'keys': {'$map': {'input': {'$objectToArray': '$$ROOT'}, 'in': '$$this.k'}}
+                }}
+            ],
+            'valid': [
+                {'$match': {'_validation_error': None}},
+                {'$count': 'count'}
+            ]
+        }}
+    ]
+
+    result = next(temporary_coll.aggregate(pipeline, allowDiskUse=True))
+    valid_count = result['valid'][0]['count'] if len(result['valid']) > 0 else 0
+
+    for doc in result['invalid']:
+        reason = doc['_validation_error']
+        if reason == 'wrong fields':
+            keys = [key for key in doc['keys'] if key != '_validation_error']
+            extra = 'expected {}, got {}'.format(sorted(VALIDATION_INPUT_FIELDS), sorted(keys))
+        elif reason == 'condition(s) not declared in output_types':
+            extra = 'expected all of {} to be in {}'.format(doc['conditions'], output_types)
+        else:
+            extra = ''
+
+        errors.append((doc['_id'], reason, extra))
+
+    # TODO check that path consists only of valid path elements
+    # TODO check that either 'obs' or 'upl' or both exists in sources with a list with length > 0
+    # TODO in case of direct analyzer make sure that the field sources only contains the elements declared in the execution_result
+    # TODO check that value is valid
+
+    return valid_count, errors
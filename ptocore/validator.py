@@ -1,7 +1,9 @@
 from datetime import datetime
-from typing import Sequence, Tuple
-from time import sleep
+from typing import Tuple
 import argparse
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import re
 from bson import ObjectId
@@ -9,15 +11,15 @@ import pymongo
 from pymongo.errors import BulkWriteError
 from pymongo.operations import UpdateOne, InsertOne
 
-from .collutils import grouper_transpose
 from .analyzerstate import AnalyzerState
-from .mongoutils import AutoIncrementFactory
+from .mongoutils import AutoIncrementFactory, watch_changes
 from .coreconfig import CoreConfig
 from .commit import commit_direct, commit_normal
 
 Interval = Tuple[datetime, datetime]
 
 pattern_ip4 = re.compile(r"^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$")
+match_ip4 = pattern_ip4.match
 
 
 class Validator:
@@ -38,8 +40,15 @@ class Validator:
         self.valid_name = 'valid.'+self.cc.environment
 
         # the validator is the only component generating action_ids, therefore create_if_missing=True is not a problem.
-        idfactory = AutoIncrementFactory(core_config.idfactory_coll)
-        self._action_id_creator = idfactory.get_incrementor('action_id', create_if_missing=True)
+        self._idfactory = AutoIncrementFactory(core_config.idfactory_coll)
+        self._action_id_creator = self._idfactory.get_incrementor('action_id', create_if_missing=True)
+
+        # indexes serving the candidate queries of commit_normal(), see commit.timespans_query()
+        self.cc.observations_coll.create_index([('analyzer_id', 1), ('time', 1)])
+        self.cc.observations_coll.create_index([('analyzer_id', 1), ('time.from', 1)])
+
+        # number of analyzer runs committed concurrently
+        self.max_workers = core_config.validator_max_concurrent
 
     def validate_upload(self, upload_id: ObjectId, valid: bool):
         """
@@ -93,43 +102,51 @@ class Validator:
         Assign a new action_id to every recently completed upload
         """
 
-        def set_action_id_ops() -> Sequence[Tuple[UpdateOne, InsertOne]]:
-            find_query = {
-                'complete': True,
-                self.action_id_name: {'$exists': False},
-                'meta.format': {'$exists': True},
-                'meta.start_time': {'$exists': True},
-                'meta.stop_time': {'$exists': True}
-            }
-
-            # apply filter from environment config
-            if isinstance(self.cc.validator_upload_filter, dict):
-                find_query.update(self.cc.validator_upload_filter)
-
-            cursor = self.cc.metadata_coll.find(find_query).sort('timestamp')
-            for upload in cursor:
-                action_id = self._action_id_creator()
-                print("assign action id {} to upload {}".format(action_id, upload['_id']))
-                uploads_query = UpdateOne({'_id': upload['_id']},
-                                          {'$set': {self.action_id_name: action_id,
-                                                    self.valid_name: True}})
-
-                timespans = [(upload['meta']['start_time'], upload['meta']['stop_time'])]
-
-                action_log_query = InsertOne({
-                    '_id': action_id,
-                    'output_formats': [upload['meta']['format']],
-                    'timespans': timespans,
-                    'action': 'upload',
-                    'upload_ids': [upload['_id']]
-                })
-
-                yield uploads_query, action_log_query
+        find_query = {
+            'complete': True,
+            self.action_id_name: {'$exists': False},
+            'meta.format': {'$exists': True},
+            'meta.start_time': {'$exists': True},
+            'meta.stop_time': {'$exists': True}
+        }
+
+        # apply filter from environment config
+        if isinstance(self.cc.validator_upload_filter, dict):
+            find_query.update(self.cc.validator_upload_filter)
+
+        num_uploads = self.cc.metadata_coll.count_documents(find_query)
+        if num_uploads == 0:
+            return
+
+        # allocate all action ids in one round-trip. uploads completed in the meantime are handled in the next
+        # round, unused ids (if uploads vanished) only leave a gap in the action log.
+        action_ids = self._idfactory.reserve('action_id', num_uploads)
+
+        uploads_ops = []
+        action_log_ops = []
+        cursor = self.cc.metadata_coll.find(find_query).sort('timestamp').limit(num_uploads)
+        for action_id, upload in zip(action_ids, cursor):
+            print("assign action id {} to upload {}".format(action_id, upload['_id']))
+            uploads_ops.append(UpdateOne({'_id': upload['_id']},
+                                         {'$set': {self.action_id_name: action_id,
+                                                   self.valid_name: True}}))
+
+            timespans = [(upload['meta']['start_time'], upload['meta']['stop_time'])]
+
+            action_log_ops.append(InsertOne({
+                '_id': action_id,
+                'output_formats': [upload['meta']['format']],
+                'timespans': timespans,
+                'action': 'upload',
+                'upload_ids': [upload['_id']]
+            }))
+
+        if len(uploads_ops) == 0:
+            return
 
         try:
-            for uploads_block, action_log_block in grouper_transpose(set_action_id_ops(), 1000):
-                self.cc.metadata_coll.bulk_write(uploads_block)
-                self.cc.action_log.bulk_write(action_log_block)
+            self.cc.metadata_coll.bulk_write(uploads_ops, ordered=False)
+            self.cc.action_log.bulk_write(action_log_ops, ordered=False)
         except BulkWriteError as e:
             # most likely a configuration error
             print(e.details)
@@ -141,57 +158,84 @@ class Validator:
         Scans the analyzers collection for analyzer modules that were executed and performs validation on their
         generated observations. If they are ok, the observations are committed to the observatory and a new action is
         inserted into the action_log.
+
+        The analyzers are committed concurrently because each commit writes to its own temporary collection and
+        only touches observations of its own analyzer_id.
+        """
+        executed = list(self.analyzer_state.executed_analyzers())
+        if len(executed) == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(executed))) as executor:
+            futures = {executor.submit(self._commit_analyzer, analyzer): analyzer['_id'] for analyzer in executed}
+            for future in as_completed(futures):
+                # a failed commit must not keep the other analyzers from being reported
+                error = future.exception()
+                if error is None:
+                    continue
+
+                analyzer_id = futures[future]
+                print("validator: committing {} failed".format(analyzer_id))
+                trace = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+                print(trace)
+
+                try:
+                    self.analyzer_state.transition_to_error(analyzer_id, 'error when executing validator:\n' + trace)
+                except Exception:
+                    traceback.print_exc()
+
+    def _commit_analyzer(self, analyzer: dict):
         """
-        executed = self.analyzer_state.executed_analyzers()
-        for analyzer in executed:
-            # check for wish
-            if self.analyzer_state.check_wish(analyzer, 'cancel'):
-                print("validator: cancelled {} upon request".format(analyzer['_id']))
-                continue
-
-            print("validating and committing {}".format(analyzer['_id']))
-
-            self.analyzer_state.transition(analyzer['_id'], 'executed', 'validating')
-
-            exe_res = analyzer['execution_result']
-            temporary_coll = self.cc.temporary_db[exe_res['temporary_coll']]
-
-            if exe_res['timespans'] is not None and exe_res['upload_ids'] is not None:
-                self.analyzer_state.transition_to_error(analyzer['_id'],
-                    'internal error: either timespans or upload_ids can have a '
-                    'value but not both. I cannot decide if direct or normal analyzer')
-                continue
-
-            if exe_res['timespans'] is None and exe_res['upload_ids'] is None:
-                self.analyzer_state.transition_to_error(analyzer['_id'],
-                    'internal error: it\'s not allowed to have both timespans and upload_ids to be None. '
-                    'I cannot decide if direct or normal analyzer')
-                continue
-
-            if exe_res['upload_ids'] is not None:
-                print("using direct commit")
-                valid_count, errors, action_id = commit_direct(
-                    analyzer['_id'], analyzer['working_dir'], self._action_id_creator,
-                    exe_res['upload_ids'], exe_res['max_action_id'], temporary_coll,
-                    self.cc.observations_coll, analyzer['output_types'],
-                    self.cc.action_log)
-            else:
-                print("using normal commit")
-                valid_count, errors, action_id = commit_normal(
-                    analyzer['_id'], analyzer['working_dir'], self._action_id_creator,
-                    exe_res['timespans'], exe_res['max_action_id'], temporary_coll,
-                    self.cc.observations_coll, analyzer['output_types'],
-                    self.cc.action_log)
-
-            if len(errors) > 0:
-                print("analyzer {} with action id {} has at least {} valid records but {} have problems:".format(analyzer['_id'], action_id, valid_count, len(errors)))
-                for idx, error in enumerate(errors):
-                    print("{}: {}".format(idx, error))
-
-                self.analyzer_state.transition_to_error(analyzer['_id'], 'error when executing validator:\n' + '\n'.join((str(error) for error in errors)))
-            else:
-                print("successfully commited analyzer {} run with action id {}. {} records inserted".format(analyzer['_id'], action_id, valid_count))
-                self.analyzer_state.transition(analyzer['_id'], 'validating', 'sensing', {'action_id': action_id})
+        Validates and commits the output of a single executed analyzer module.
+        """
+        # check for wish
+        if self.analyzer_state.check_wish(analyzer, 'cancel'):
+            print("validator: cancelled {} upon request".format(analyzer['_id']))
+            return
+
+        print("validating and committing {}".format(analyzer['_id']))
+
+        self.analyzer_state.transition(analyzer['_id'], 'executed', 'validating')
+
+        exe_res = analyzer['execution_result']
+        temporary_coll = self.cc.temporary_db[exe_res['temporary_coll']]
+
+        if exe_res['timespans'] is not None and exe_res['upload_ids'] is not None:
+            self.analyzer_state.transition_to_error(analyzer['_id'],
+                'internal error: either timespans or upload_ids can have a '
+                'value but not both. I cannot decide if direct or normal analyzer')
+            return
+
+        if exe_res['timespans'] is None and exe_res['upload_ids'] is None:
+            self.analyzer_state.transition_to_error(analyzer['_id'],
+                'internal error: it\'s not allowed to have both timespans and upload_ids to be None. '
+                'I cannot decide if direct or normal analyzer')
+            return
+
+        if exe_res['upload_ids'] is not None:
+            print("using direct commit")
+            valid_count, errors, action_id = commit_direct(
+                analyzer['_id'], analyzer['working_dir'], self._action_id_creator,
+                exe_res['upload_ids'], exe_res['max_action_id'], temporary_coll,
+                self.cc.observations_coll, analyzer['output_types'],
+                self.cc.action_log)
+        else:
+            print("using normal commit")
+            valid_count, errors, action_id = commit_normal(
+                analyzer['_id'], analyzer['working_dir'], self._action_id_creator,
+                exe_res['timespans'], exe_res['max_action_id'], temporary_coll,
+                self.cc.observations_coll, analyzer['output_types'],
+                self.cc.action_log)
+
+        if len(errors) > 0:
+            print("analyzer {} with action id {} has at least {} valid records but {} have problems:".format(analyzer['_id'], action_id, valid_count, len(errors)))
+            for idx, error in enumerate(errors):
+                print("{}: {}".format(idx, error))
+
+            self.analyzer_state.transition_to_error(analyzer['_id'], 'error when executing validator:\n' + '\n'.join((str(error) for error in errors)))
+        else:
+            print("successfully commited analyzer {} run with action id {}. {} records inserted".format(analyzer['_id'], action_id, valid_count))
+            self.analyzer_state.transition(analyzer['_id'], 'validating', 'sensing', {'action_id': action_id})
 
 
     def check_for_work(self):
@@ -214,9 +258,27 @@ def main():
 
     val = Validator(cc)
 
+    # wake up as soon as there is something to do. polling is kept as fallback in case change streams are not
+    # available (e.g. no replica set) or an event was missed.
+    wakeup = threading.Event()
+    watches = [
+        (cc.analyzers_coll, [{'$match': {
+            'operationType': 'update',
+            'updateDescription.updatedFields.state': 'executed'}}]),
+        (cc.metadata_coll, [{'$match': {'$or': [
+            {'operationType': {'$in': ['insert', 'replace']}, 'fullDocument.complete': True},
+            {'operationType': 'update', 'updateDescription.updatedFields.complete': True}]}}]),
+        (cc.requests_coll, [{'$match': {
+            'operationType': 'insert',
+            'fullDocument.receiver': 'validator'}}])
+    ]
+    for coll, pipeline in watches:
+        threading.Thread(target=watch_changes, args=(coll, pipeline, wakeup.set), daemon=True).start()
+
     while True:
         val.check_for_work()
-        sleep(4)
+        wakeup.wait(4)
+        wakeup.clear()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -25,15 +25,22 @@ setup(
         'Intended Audience :: Science/Research',
         'Topic :: Software Development :: Build Tools',
 
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.7',
     ],
 
     keywords='',
 
     packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
 
+    python_requires='>=3.7',
+
     install_requires=['python-dateutil', 'pymongo', 'flask', 'flask_cors', 'jsonschema', 'dpath'],
 
+    extras_require={
+        'uvloop': ['uvloop>=0.15'],
+        'orjson': ['orjson'],
+    },
+
     entry_points={
         'console_scripts': [
             'ptocore-sensor = ptocore.sensor:main',
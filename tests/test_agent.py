@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import unittest
+from collections import deque
+from types import SimpleNamespace
+
+from ptocore.agent import _drain, ModuleAgent
+
+
+def drain(data, max_size, chunk_size):
+    loop = asyncio.new_event_loop()
+    try:
+        stream = asyncio.StreamReader(loop=loop)
+        stream.feed_data(data)
+        stream.feed_eof()
+        return loop.run_until_complete(_drain(stream, max_size, chunk_size))
+    finally:
+        loop.close()
+
+
+class TestDrain(unittest.TestCase):
+    def test_drain_keeps_everything_below_limit(self):
+        self.assertEqual(drain(b'0123456789', 10, 3), (b'0123456789', 0))
+        self.assertEqual(drain(b'', 10, 3), (b'', 0))
+
+    def test_drain_keeps_tail(self):
+        data = bytes(range(100))
+        for chunk_size in (1, 3, 7, 64, 200):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(drain(data, 10, chunk_size), (data[-10:], 90))
+
+
+class RecordingDatabase:
+    def __init__(self):
+        self.calls = []
+
+    def remove_user(self, name):
+        self.calls.append(('remove_user', name))
+
+    def command(self, name, arg):
+        self.calls.append((name, arg))
+
+    def drop_collection(self, name):
+        self.calls.append(('drop_collection', name))
+
+
+class TestModuleAgent(unittest.TestCase):
+    def make_agent(self):
+        # bypass the constructor, it creates the user and collection in MongoDB
+        agent = ModuleAgent.__new__(ModuleAgent)
+        agent.identifier = 'module_1'
+        agent.logger = logging.getLogger('test')
+        agent.core_config = SimpleNamespace(temporary_db=RecordingDatabase())
+        agent.stack = deque([agent._delete_user])
+        return agent
+
+    def test_teardown_keeps_collection(self):
+        agent = self.make_agent()
+        agent.teardown()
+        self.assertSequenceEqual(agent.core_config.temporary_db.calls,
+                                 [('remove_user', 'module_1'), ('dropRole', 'module_1')])
+
+    def test_discard_deletes_collection_last(self):
+        agent = self.make_agent()
+        agent.discard()
+        self.assertSequenceEqual(agent.core_config.temporary_db.calls,
+                                 [('remove_user', 'module_1'), ('dropRole', 'module_1'),
+                                  ('drop_collection', 'module_1')])
+
+if __name__ == '__main__':
+    unittest.main()
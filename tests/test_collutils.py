@@ -0,0 +1,18 @@
+import unittest
+
+from ptocore.collutils import grouper, grouper_transpose
+
+
+class TestGrouper(unittest.TestCase):
+    def test_grouper(self):
+        self.assertSequenceEqual(list(grouper(range(7), 3)), [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertSequenceEqual(list(grouper(range(6), 3)), [[0, 1, 2], [3, 4, 5]])
+        self.assertSequenceEqual(list(grouper([], 3)), [])
+
+    def test_grouper_transpose(self):
+        pairs = ((n, str(n)) for n in range(5))
+        self.assertSequenceEqual(list(grouper_transpose(pairs, 3)),
+                                 [[[0, 1, 2], ['0', '1', '2']], [[3, 4], ['3', '4']]])
+
+if __name__ == '__main__':
+    unittest.main()
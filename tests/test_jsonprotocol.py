@@ -0,0 +1,57 @@
+import json
+import unittest
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+from ptocore.jsonprotocol import JsonProtocol, dumps, loads
+
+
+class TestJsonCodec(unittest.TestCase):
+    def test_roundtrip(self):
+        obj = {'action': 'set_result_info', 'payload': {'max_action_id': 3, 'timespans': [['a', 'b']]}}
+        self.assertEqual(loads(dumps(obj)), obj)
+
+    def test_matches_json_module(self):
+        oid = ObjectId('5865fb2e1d41c8bd93d6b1d3')
+        time = datetime(2017, 1, 2, 3, 4, 5, 6)
+        obj = {'upload_ids': [oid], 'time': time, 'n': None}
+        expected = {'upload_ids': [str(oid)], 'time': time.isoformat(), 'n': None}
+        self.assertEqual(loads(dumps(obj)), expected)
+        self.assertEqual(json.loads(dumps(obj).decode()), expected)
+
+class CollectingProtocol(JsonProtocol):
+    __slots__ = ('messages',)
+
+    def __init__(self):
+        self.messages = []
+        self.connection_made(None)
+
+    def received(self, obj):
+        self.messages.append(obj)
+
+
+class TestJsonProtocol(unittest.TestCase):
+    def test_several_messages_per_chunk(self):
+        proto = CollectingProtocol()
+        proto.data_received(b'{"a":1}\n{"b":2}\n{"c"')
+        self.assertEqual(proto.messages, [{'a': 1}, {'b': 2}])
+
+        proto.data_received(b':3}\n')
+        self.assertEqual(proto.messages, [{'a': 1}, {'b': 2}, {'c': 3}])
+
+    def test_split_message(self):
+        data = dumps({'action': 'get_info', 'payload': [1, 2, 3]}) + b'\n'
+        proto = CollectingProtocol()
+        for i in range(len(data)):
+            proto.data_received(data[i:i+1])
+
+        self.assertEqual(proto.messages, [{'action': 'get_info', 'payload': [1, 2, 3]}])
+
+    def test_invalid_message_is_skipped(self):
+        proto = CollectingProtocol()
+        proto.data_received(b'{"a":1}\nnot json\n{"b":2}\n')
+        self.assertEqual(proto.messages, [{'a': 1}, {'b': 2}])
+
+if __name__ == '__main__':
+    unittest.main()
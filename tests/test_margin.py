@@ -46,6 +46,28 @@ class TestTimelineMargin(unittest.TestCase):
 
         self.assertSequenceEqual(out, [(11, 20), (0, 5)])
 
+    def test_unsorted_chain(self):
+        # (8, 10) bridges (0, 5) and (12, 20) only after they have been merged with it
+        offset = 5
+        inp = [(30, 40), (0, 5), (12, 20), (8, 10)]
+        out = timeline.margin(offset, inp)
+
+        self.assertSequenceEqual(sorted(out), [(0, 20), (30, 40)])
+
+    def test_contained(self):
+        offset = 2
+        inp = [(0, 100), (10, 20), (50, 60), (103, 110), (200, 210)]
+        out = timeline.margin(offset, inp)
+
+        self.assertSequenceEqual(sorted(out), [(0, 100), (103, 110), (200, 210)])
+
+    def test_zero_offset(self):
+        offset = 0
+        inp = [(0, 5), (5, 9), (10, 12)]
+        out = timeline.margin(offset, inp)
+
+        self.assertSequenceEqual(sorted(out), [(0, 9), (10, 12)])
+
     def test_6(self):
         offset = timedelta(seconds=30)
         inp = [
@@ -5,12 +5,16 @@ from bson.objectid import ObjectId
 
 from ptocore import sensitivity
 
+oid_a = ObjectId('A76670ee31e34a281d600a31')
+oid_b = ObjectId('B76670ee31e34a281d600a31')
+oid_new = ObjectId('5773850731e34a206bde8ab6')
+
 upload_a = {
     '_id': 0,
     'action': 'upload',
     'output_formats': ['format0'],
     'timespans': [[datetime(2016, 6, 12, 4, 0), datetime(2016, 6, 12, 8, 0)]],
-    'upload_ids': [ObjectId('A76670ee31e34a281d600a31')]
+    'upload_ids': [oid_a]
 }
 
 analyze_0 = {
@@ -21,7 +25,7 @@ analyze_0 = {
     'timespans': [
         [datetime(2016, 6, 12, 4, 0), datetime(2016, 6, 12, 8, 0)]
     ],
-    'upload_ids': [ObjectId('A76670ee31e34a281d600a31')],
+    'upload_ids': [oid_a],
     'max_action_id': 0
 }
 
@@ -30,7 +34,7 @@ upload_b = {
     'action': 'upload',
     'output_formats': ['format0'],
     'timespans': [[datetime(2016, 6, 12, 6, 0), datetime(2016, 6, 12, 10, 0)]],
-    'upload_ids': [ObjectId('B76670ee31e34a281d600a31')]
+    'upload_ids': [oid_b]
 }
 
 analyze_1 = {
@@ -41,7 +45,7 @@ analyze_1 = {
     'timespans': [
         [datetime(2016, 6, 12, 6, 0), datetime(2016, 6, 12, 10, 0)]
     ],
-    'upload_ids': [ObjectId('B76670ee31e34a281d600a31')],
+    'upload_ids': [oid_b],
     'max_action_id': 2
 }
 
@@ -92,13 +96,13 @@ class TestSensitivity(unittest.TestCase):
 
     def test_new_old(self):
         input_actions = [
-            {'action': 'analyze', 'upload_ids': [ObjectId('5773850731e34a206bde8ab6')], '_id': 82, 'timespans': [[datetime(2016, 6, 28, 0, 0), datetime(2016, 6, 29, 0, 0)]]},
-            {'action': 'analyze', 'upload_ids': [ObjectId('5773850731e34a206bde8ab6')], '_id': 75, 'timespans': [[datetime(2016, 6, 28, 0, 0), datetime(2016, 6, 29, 0, 0)]]},
-            {'action': 'analyze', 'upload_ids': [ObjectId('5773850731e34a206bde8ab6')], '_id': 73, 'timespans': [[datetime(2016, 6, 28, 0, 0), datetime(2016, 6, 29, 0, 0)]]},
-            {'action': 'analyze', 'upload_ids': [ObjectId('5773850731e34a206bde8ab6')], '_id': 71, 'timespans': [[datetime(2016, 6, 28, 0, 0), datetime(2016, 6, 29, 0, 0)]]},
-            {'action': 'analyze', 'upload_ids': [ObjectId('5773850731e34a206bde8ab6')], '_id': 69, 'timespans': [[datetime(2016, 6, 28, 0, 0), datetime(2016, 6, 29, 0, 0)]]},
+            {'action': 'analyze', 'upload_ids': [oid_new], '_id': 82, 'timespans': [[datetime(2016, 6, 28, 0, 0), datetime(2016, 6, 29, 0, 0)]]},
+            {'action': 'analyze', 'upload_ids': [oid_new], '_id': 75, 'timespans': [[datetime(2016, 6, 28, 0, 0), datetime(2016, 6, 29, 0, 0)]]},
+            {'action': 'analyze', 'upload_ids': [oid_new], '_id': 73, 'timespans': [[datetime(2016, 6, 28, 0, 0), datetime(2016, 6, 29, 0, 0)]]},
+            {'action': 'analyze', 'upload_ids': [oid_new], '_id': 71, 'timespans': [[datetime(2016, 6, 28, 0, 0), datetime(2016, 6, 29, 0, 0)]]},
+            {'action': 'analyze', 'upload_ids': [oid_new], '_id': 69, 'timespans': [[datetime(2016, 6, 28, 0, 0), datetime(2016, 6, 29, 0, 0)]]},
             {'action': 'analyze', 'upload_ids': [ObjectId('576670ee31e34a281d600a31')], '_id': 67, 'timespans': [[datetime(2016, 6, 12, 0, 0), datetime(2016, 6, 13, 0, 0)]]},
-            {'action': 'analyze', 'upload_ids': [ObjectId('5773850731e34a206bde8ab6')], '_id': 66, 'timespans': [[datetime(2016, 6, 28, 0, 0), datetime(2016, 6, 29, 0, 0)]]},
+            {'action': 'analyze', 'upload_ids': [oid_new], '_id': 66, 'timespans': [[datetime(2016, 6, 28, 0, 0), datetime(2016, 6, 29, 0, 0)]]},
             {'action': 'analyze', 'upload_ids': [ObjectId('5774a52d31e34a206bde8abc')], '_id': 65, 'timespans': [[datetime(2016, 6, 29, 0, 0), datetime(2016, 6, 30, 0, 0)]]},
             {'action': 'analyze', 'upload_ids': [ObjectId('5774a27631e34a206bde8ab9')], '_id': 64, 'timespans': [[datetime(2016, 6, 29, 0, 0), datetime(2016, 6, 30, 0, 0)]]},
             {'action': 'analyze', 'upload_ids': [ObjectId('5767a53731e34a6c3925a72b')], '_id': 63, 'timespans': [[datetime(1970, 1, 14, 11, 58, 0, 64000), datetime(1970, 1, 14, 17, 13, 13, 64000)]]},
@@ -5,12 +5,16 @@ from bson.objectid import ObjectId
 
 from ptocore import sensitivity
 
+oid_a = ObjectId('A76670ee31e34a281d600a31')
+oid_b = ObjectId('B76670ee31e34a281d600a31')
+oid_c = ObjectId('5774a52d31e34a206bde8abc')
+
 upload_a = {
     '_id': 0,
     'action': 'upload',
     'output_formats': ['format0'],
     'timespans': [[datetime(2016, 6, 12, 0, 0), datetime(2016, 6, 13, 0, 0)]],
-    'upload_ids': [ObjectId('A76670ee31e34a281d600a31')]
+    'upload_ids': [oid_a]
 }
 
 analyze_a = {
@@ -21,7 +25,7 @@ analyze_a = {
     'timespans': [
         [datetime(2016, 6, 12, 0, 0), datetime(2016, 6, 13, 0, 0)]
     ],
-    'upload_ids': [ObjectId('A76670ee31e34a281d600a31')],
+    'upload_ids': [oid_a],
     'max_action_id': 0
 }
 
@@ -30,7 +34,7 @@ upload_b = {
     'action': 'upload',
     'output_formats': ['format0'],
     'timespans': [[datetime(2016, 6, 12, 0, 0), datetime(2016, 6, 13, 0, 0)]],
-    'upload_ids': [ObjectId('B76670ee31e34a281d600a31')]
+    'upload_ids': [oid_b]
 }
 
 analyze_b = {
@@ -41,7 +45,7 @@ analyze_b = {
     'timespans': [
         [datetime(2016, 6, 12, 0, 0), datetime(2016, 6, 13, 0, 0)]
     ],
-    'upload_ids': [ObjectId('B76670ee31e34a281d600a31')],
+    'upload_ids': [oid_b],
     'max_action_id': 2
 }
 
@@ -50,7 +54,7 @@ mark_invalid_a = {
     'action': 'marked_invalid',
     'output_formats': ['format0'],
     'timespans': [[datetime(2016, 6, 12, 0, 0), datetime(2016, 6, 13, 0, 0)]],
-    'upload_ids': [ObjectId('A76670ee31e34a281d600a31')]
+    'upload_ids': [oid_a]
 }
 
 analyze_a_2 = {
@@ -61,7 +65,7 @@ analyze_a_2 = {
     'timespans': [
         [datetime(2016, 6, 12, 0, 0), datetime(2016, 6, 13, 0, 0)]
     ],
-    'upload_ids': [ObjectId('A76670ee31e34a281d600a31')],
+    'upload_ids': [oid_a],
     'max_action_id': 4
 }
 
@@ -70,7 +74,7 @@ mark_valid_a = {
     'action': 'marked_valid',
     'output_formats': ['format0'],
     'timespans': [[datetime(2016, 6, 12, 0, 0), datetime(2016, 6, 13, 0, 0)]],
-    'upload_ids': [ObjectId('A76670ee31e34a281d600a31')]
+    'upload_ids': [oid_a]
 }
 
 class TestSensitivityDirect(unittest.TestCase):
@@ -100,7 +104,7 @@ class TestSensitivityDirect(unittest.TestCase):
         max_action_id, upload_ids = action_set.direct()
 
         self.assertEqual(max_action_id, 0)
-        self.assertSequenceEqual(upload_ids, [ObjectId('A76670ee31e34a281d600a31')])
+        self.assertSequenceEqual(upload_ids, [oid_a])
 
     def test_two_uploaded_none_analyzed(self):
         """
@@ -115,7 +119,7 @@ class TestSensitivityDirect(unittest.TestCase):
         max_action_id, upload_ids = action_set.direct()
 
         self.assertEqual(max_action_id, 2)
-        self.assertSequenceEqual(upload_ids, [ObjectId('A76670ee31e34a281d600a31'), ObjectId('B76670ee31e34a281d600a31')])
+        self.assertSequenceEqual(upload_ids, [oid_a, oid_b])
 
     def test_two_uploaded_one_analyzed(self):
         """
@@ -132,7 +136,7 @@ class TestSensitivityDirect(unittest.TestCase):
         max_action_id, upload_ids = action_set.direct()
 
         self.assertEqual(max_action_id, 2)
-        self.assertSequenceEqual(upload_ids, [ObjectId('B76670ee31e34a281d600a31')])
+        self.assertSequenceEqual(upload_ids, [oid_b])
 
     def test_two_uploads_both_analyzed(self):
         """
@@ -166,7 +170,7 @@ class TestSensitivityDirect(unittest.TestCase):
         max_action_id, upload_ids = action_set.direct()
 
         self.assertEqual(max_action_id, 4)
-        self.assertSequenceEqual(upload_ids, [ObjectId('A76670ee31e34a281d600a31')])
+        self.assertSequenceEqual(upload_ids, [oid_a])
 
     def test_two_uploads_both_analyzed_one_invalid_valid(self):
         """
@@ -184,18 +188,18 @@ class TestSensitivityDirect(unittest.TestCase):
         max_action_id, upload_ids = action_set.direct()
 
         self.assertEqual(max_action_id, 6)
-        self.assertSequenceEqual(upload_ids, [ObjectId('A76670ee31e34a281d600a31')])
+        self.assertSequenceEqual(upload_ids, [oid_a])
 
     def test_valid_invalid_play(self):
         input_actions = [
             {
-                'upload_ids': [ObjectId('5774a52d31e34a206bde8abc')],
+                'upload_ids': [oid_c],
                 'timespans': [[datetime(2016, 6, 29, 0, 0), datetime(2016, 6, 30, 0, 0)]],
                 'action': 'marked_invalid',
                 '_id': 21
             },
             {
-                'upload_ids': [ObjectId('5774a52d31e34a206bde8abc')],
+                'upload_ids': [oid_c],
                 'timespans': [[datetime(2016, 6, 29, 0, 0), datetime(2016, 6, 30, 0, 0)]],
                 'action': 'upload',
                 '_id': 16
@@ -203,7 +207,7 @@ class TestSensitivityDirect(unittest.TestCase):
         ]
         output_actions = [
             {
-                'upload_ids': [ObjectId('5774a52d31e34a206bde8abc')],
+                'upload_ids': [oid_c],
                 'git_url': 'git@github.com:gubser/analyzer-ecnspider1.git',
                 'git_commit': 'e19db7ba691a85f2af29a04d18374216592c74e6',
                 'max_action_id': 16,
@@ -211,7 +215,7 @@ class TestSensitivityDirect(unittest.TestCase):
                 'timespans': [[datetime(2016, 6, 29, 0, 0), datetime(2016, 6, 30, 0, 0)]]
             },
             {
-                'upload_ids': [ObjectId('5774a52d31e34a206bde8abc')],
+                'upload_ids': [oid_c],
                 'git_url': 'git@github.com:gubser/analyzer-ecnspider1.git',
                 'git_commit': 'e19db7ba691a85f2af29a04d18374216592c74e6',
                 'max_action_id': 19,
@@ -226,4 +230,4 @@ class TestSensitivityDirect(unittest.TestCase):
         max_action_id, upload_ids = action_set.direct()
 
         self.assertEqual(max_action_id, 21)
-        self.assertSequenceEqual(upload_ids, [ObjectId('5774a52d31e34a206bde8abc')])
\ No newline at end of file
+        self.assertSequenceEqual(upload_ids, [oid_c])
\ No newline at end of file
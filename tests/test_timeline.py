@@ -3,79 +3,51 @@ import unittest
 from ptocore import timeline
 
 
-class TestTimeline(unittest.TestCase):
-    def test_1(self):
-        tl = timeline.Timeline()
-        tl.add_interval(2, 4)
-        self.assertSequenceEqual(tl.intervals, [(2, 4)])
-
-    def test_2(self):
-        tl = timeline.Timeline()
-        tl.add_interval(2, 4)
-        tl.add_interval(0, 2)
-        self.assertSequenceEqual(tl.intervals, [(0, 4)])
-
-    def test_3(self):
-        tl = timeline.Timeline()
-        tl.add_interval(0, 1)
-        tl.add_interval(2, 3)
-        self.assertSequenceEqual(tl.intervals, [(0, 1), (2, 3)])
-
-    def test_4(self):
-        tl = timeline.Timeline()
-        tl.add_interval(2, 3)
-        tl.add_interval(0, 1)
-        self.assertSequenceEqual(tl.intervals, [(2, 3), (0, 1)])
-
-    def test_tl_add_0(self):
-        tl0 = timeline.Timeline()
-        tl0.add_interval(0, 1)
-
-        tl1 = timeline.Timeline()
-        tl1.add_interval(2, 3)
-
-        tl2 = tl0 + tl1
-        self.assertSequenceEqual(tl2.intervals, [(0, 1), (2, 3)])
-
-    def test_tl_add_1(self):
-        tl0 = timeline.Timeline()
-        tl0.add_interval(0, 1)
-
-        tl1 = timeline.Timeline()
-        tl1.add_interval(1, 2)
+def make_timeline(intervals):
+    tl = timeline.Timeline()
+    for a, b in intervals:
+        tl.add_interval(a, b)
+    return tl
 
-        tl2 = tl0 + tl1
-        self.assertSequenceEqual(tl2.intervals, [(0, 2)])
 
-    def test_tl_sub_0(self):
-        tl0 = timeline.Timeline()
-        tl0.add_interval(0, 4)
-
-        tl1 = timeline.Timeline()
-        tl1.add_interval(1, 2)
-
-        tl2 = tl0 - tl1
-        self.assertSequenceEqual(tl2.intervals, [(0, 1), (2, 4)])
-
-    def test_tl_sub_1(self):
-        tl0 = timeline.Timeline()
-        tl0.add_interval(0, 4)
-
-        tl1 = timeline.Timeline()
-        tl1.add_interval(3, 5)
-
-        tl2 = tl0 - tl1
-        self.assertSequenceEqual(tl2.intervals, [(0, 3)])
-
-    def test_tl_sub_2(self):
-        tl0 = timeline.Timeline()
-        tl0.add_interval(0, 4)
-
-        tl1 = timeline.Timeline()
-        tl1.add_interval(-1, 3)
-
-        tl2 = tl0 - tl1
-        self.assertSequenceEqual(tl2.intervals, [(3, 4)])
+class TestTimeline(unittest.TestCase):
+    # intervals added in this order, expected intervals
+    ADD_CASES = [
+        ([(2, 4)], [(2, 4)]),
+        ([(2, 4), (0, 2)], [(0, 4)]),
+        ([(0, 1), (2, 3)], [(0, 1), (2, 3)]),
+        ([(2, 3), (0, 1)], [(2, 3), (0, 1)]),
+    ]
+
+    # intervals of the left and right operand, expected intervals
+    TL_ADD_CASES = [
+        ([(0, 1)], [(2, 3)], [(0, 1), (2, 3)]),
+        ([(0, 1)], [(1, 2)], [(0, 2)]),
+    ]
+
+    TL_SUB_CASES = [
+        ([(0, 4)], [(1, 2)], [(0, 1), (2, 4)]),
+        ([(0, 4)], [(3, 5)], [(0, 3)]),
+        ([(0, 4)], [(-1, 3)], [(3, 4)]),
+    ]
+
+    def test_add_interval(self):
+        for intervals, expected in self.ADD_CASES:
+            with self.subTest(intervals=intervals):
+                tl = make_timeline(intervals)
+                self.assertSequenceEqual(tl.intervals, expected)
+
+    def test_tl_add(self):
+        for left, right, expected in self.TL_ADD_CASES:
+            with self.subTest(left=left, right=right):
+                tl = make_timeline(left) + make_timeline(right)
+                self.assertSequenceEqual(tl.intervals, expected)
+
+    def test_tl_sub(self):
+        for left, right, expected in self.TL_SUB_CASES:
+            with self.subTest(left=left, right=right):
+                tl = make_timeline(left) - make_timeline(right)
+                self.assertSequenceEqual(tl.intervals, expected)
 
 if __name__ == '__main__':
     unittest.main()